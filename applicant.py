@@ -0,0 +1,27 @@
+import config as cfg
+
+# The applicant record.  An applicant is one row of the Session Manager import file: a fixed length list holding the
+# values in column order.  The column order and the position of every form label are worked out once from
+# cfg.Header.fields, so filling in a field is a list store and writing the row needs no dict at all.
+
+# Column headers of the import file, in order.
+columns = tuple(cfg.Header.fields.values())
+# Row position of each form label and of each column name.
+label_position = {label: position for position, label in enumerate(cfg.Header.fields)}
+column_position = {column: position for position, column in enumerate(columns)}
+
+# Columns that are never set on a form are written empty, like DictWriter does for missing keys.
+blank_row = [''] * len(columns)
+
+
+class Applicant(list):
+    # __slots__ keeps the per-instance __dict__ away, an applicant costs the list and nothing more.  Being a list it
+    # pickles compactly on the way back from the parse workers and can be handed to csv.writer as it is.
+    __slots__ = ()
+
+    def __init__(self, values=blank_row):
+        super().__init__(values)
+
+    def get(self, column):
+        # Value of the column with the given header name, e.g. applicant.get('E_MAIL').
+        return self[column_position[column]]
@@ -0,0 +1,177 @@
+from applicant import columns
+import argparse
+import config as cfg
+import csv
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+
+# Local SQLite store of every applicant the pipeline has exported.  Each applicant is stored with the mailbox folder
+# (or archive) and UID of its registration form, the time the form was received and the exam session, so a Session
+# Manager import file for any date range or session can be rebuilt from the store in milliseconds, without logging
+# into the mail server:
+#
+#     python applicant_store.py export --since 2024-06-01 --before 2024-06-08
+#     python applicant_store.py export --session 2024-06-15 --output june.csv
+#     python applicant_store.py find --callsign KD9ABC
+#
+# A form that is processed again, because an export was resumed, an archive was read a second time or the mailbox got
+# a new UIDVALIDITY, replaces its earlier row instead of adding another one.  Forms are matched by their Message-ID,
+# and by their folder and UID when they have none.  Submissions superseded by a later form of the same applicant (see
+# dedup.py) stay in the store but are left out of exports.
+
+# Columns looked up often enough to be indexed, the receipt time is indexed as well.
+indexed_columns = ('E_MAIL', 'FRN', 'CALL_SIGN')
+# Stored next to the applicant's columns.
+record_columns = ('source', 'uidvalidity', 'uid', 'received', 'session', 'message')
+
+
+def quote(name):
+    # Quote a column name for use in SQL.
+    return '"' + name.replace('"', '""') + '"'
+
+
+def text(value):
+    # Values are stored as the text the csv file holds, so an export writes exactly what the pipeline wrote.
+    return value if type(value) is str else str(value)
+
+
+class ApplicantStore:
+    def __init__(self, database):
+        self.connection = sqlite3.connect(database)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.create_schema()
+        names = ', '.join(quote(name) for name in record_columns + columns)
+        placeholders = ', '.join('?' * (len(record_columns) + len(columns)))
+        updates = ', '.join(f'{quote(name)} = excluded.{quote(name)}' for name in record_columns[3:] + columns)
+        self.upsert_sql = (f'INSERT INTO applicants ({names}) VALUES ({placeholders}) '
+                           f'ON CONFLICT (message) WHERE message IS NOT NULL DO UPDATE SET {updates} '
+                           f'ON CONFLICT (source, uidvalidity, uid) DO UPDATE SET {updates}')
+
+    def create_schema(self):
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS applicants (source TEXT NOT NULL, uidvalidity INTEGER NOT NULL, '
+                'uid INTEGER NOT NULL, received TEXT, session TEXT, PRIMARY KEY (source, uidvalidity, uid))')
+            # columns added after the store was created are added to the table
+            existing = {row[1] for row in self.connection.execute('PRAGMA table_info(applicants)')}
+            if 'superseded' not in existing:
+                self.connection.execute('ALTER TABLE applicants ADD COLUMN superseded INTEGER NOT NULL DEFAULT 0')
+            if 'message' not in existing:
+                self.connection.execute('ALTER TABLE applicants ADD COLUMN message TEXT')
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS applicants_message ON applicants (message) '
+                                    'WHERE message IS NOT NULL')
+            for column in columns:
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE applicants ADD COLUMN {quote(column)} TEXT')
+            for column in indexed_columns + ('received', 'session'):
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {quote("applicants_" + column.lower())} '
+                                        f'ON applicants ({quote(column)})')
+
+    def add(self, checkpoint, messages, applicants, session=None):
+        # Upsert the applicants of one batch.  The rows become visible with the next commit(), so a whole batch, or
+        # several, is written in a single transaction.
+        source = checkpoint['key']
+        uidvalidity = checkpoint['uidvalidity'] or 0
+        rows = []
+        for msg, applicant in zip(messages, applicants):
+            received = msg.received.isoformat(sep=' ', timespec='seconds') if msg.received else None
+            rows.append((source, uidvalidity, int(msg.uid), received, session, msg.message_id,
+                         *map(text, applicant)))
+        self.connection.executemany(self.upsert_sql, rows)
+
+    def supersede(self, keys):
+        # Mark the submissions with the given (source, uidvalidity, uid, message) keys as superseded.
+        self.connection.executemany('UPDATE applicants SET superseded = 1 '
+                                    'WHERE source = ? AND uidvalidity = ? AND uid = ? OR message = ?', keys)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def select(self, since=None, before=None, session=None):
+        # Rows in column order of the applicants received from since up to, not including, before (dates or
+        # datetimes), and registered for session, in order of receipt.  Superseded submissions are left out.
+        conditions = ['superseded = 0']
+        parameters = []
+        if since is not None:
+            conditions.append('received >= ?')
+            parameters.append(since.isoformat(sep=' ') if type(since) is datetime.datetime else since.isoformat())
+        if before is not None:
+            conditions.append('received < ?')
+            parameters.append(before.isoformat(sep=' ') if type(before) is datetime.datetime else before.isoformat())
+        if session is not None:
+            conditions.append('session = ?')
+            parameters.append(session)
+        return self.connection.execute(
+            f'SELECT {", ".join(map(quote, columns))} FROM applicants WHERE {" AND ".join(conditions)} '
+            f'ORDER BY received, source, uid',
+            parameters)
+
+    def find(self, column, value):
+        # Stored records (record columns followed by the applicant's columns) with the given value in an indexed
+        # column, newest first.
+        if column not in indexed_columns:
+            raise ValueError(f'{column} is not indexed, expected one of {", ".join(indexed_columns)}.')
+        return self.connection.execute(
+            f'SELECT {", ".join(map(quote, record_columns + columns))} FROM applicants '
+            f'WHERE {quote(column)} = ? ORDER BY received DESC', (value,))
+
+    def export(self, filename, since=None, before=None, session=None):
+        # Write a Session Manager import file for the selected applicants and return how many it holds.  The file
+        # is written under a temporary name and renamed, so it is never seen half written.
+        count = 0
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(columns)
+            for row in self.select(since, before, session):
+                writer.writerow(row)
+                count += 1
+        os.replace(tmp_filename, filename)
+        logging.info('Exported %d stored applicants to %s.', count, filename)
+        return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the applicant store and rebuild import files from it.')
+    parser.add_argument('--database', default=cfg.Store.database, help='store to read (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write a Session Manager import file from the store')
+    export.add_argument('--since', type=datetime.date.fromisoformat, help='first day of receipt, YYYY-MM-DD')
+    export.add_argument('--before', type=datetime.date.fromisoformat, help='day after the last day of receipt')
+    export.add_argument('--session', help='only applicants registered for this exam session')
+    export.add_argument('--output', help='file to write (default: a new timestamped _session_import.csv)')
+    find = commands.add_parser('find', help='list the stored applicants with an e-mail address, FRN or callsign')
+    lookup = find.add_mutually_exclusive_group(required=True)
+    lookup.add_argument('--email', dest='E_MAIL')
+    lookup.add_argument('--frn', dest='FRN')
+    lookup.add_argument('--callsign', dest='CALL_SIGN', type=str.upper)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.database):
+        parser.error(f'applicant store {args.database} does not exist')
+    store = ApplicantStore(args.database)
+    try:
+        if args.command == 'export':
+            output = args.output or datetime.datetime.now().strftime("%m%d%Y_%H%M%S") + "_session_import.csv"
+            count = store.export(output, args.since, args.before, args.session)
+            print(f'Exported {count} applicants to {output}.')
+        else:
+            column = next(column for column in indexed_columns if getattr(args, column) is not None)
+            writer = csv.writer(sys.stdout)
+            writer.writerow(record_columns + columns)
+            writer.writerows(store.find(column, getattr(args, column)))
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+from collections import deque
+from imap_fetch import connect_mailbox, fetch_html_batches, fetch_message_batches
+from imap_tools.errors import UnexpectedCommandStatusError
+from sync_state import mailbox_key, find_new_uids
+import asyncio
+import config as cfg
+import imaplib
+import logging
+import metrics
+
+# asyncio ingestion of several intake mailboxes at once.  Each account in cfg.Mailboxes.accounts gets a small pool of
+# reusable IMAP connections, its size is the account's concurrency limit.  Every folder of every account is read at
+# the same time, so a run takes as long as the slowest mailbox instead of the sum of all of them.
+#
+# imaplib is blocking, so the IMAP commands themselves run in threads via asyncio.to_thread().  Batches of a folder
+# are fetched concurrently but written strictly in UID order, which keeps the sync checkpoint of each folder valid.
+
+# Errors that mean the connection or the server had a problem and the command is worth retrying.
+retry_errors = (imaplib.IMAP4.error, OSError, UnexpectedCommandStatusError)
+
+
+class ImapConnectionPool:
+    def __init__(self, account):
+        self.account = account
+        self.size = account.get('concurrency', 2)
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(self.size)
+
+    def connect(self):
+        logging.info('Logging into Mail Server: %s as %s.', self.account['server'], self.account['user'])
+        return connect_mailbox(self.account['server'], self.account['user'], self.account['password'], folder=None,
+                               port=self.account.get('port', 993), ssl=self.account.get('ssl', True))
+
+    async def acquire(self):
+        # Wait for a free slot, then reuse an idle connection or open a new one.
+        await self.semaphore.acquire()
+        if self.idle:
+            return self.idle.pop()
+        try:
+            return await asyncio.to_thread(self.connect)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self, mb):
+        self.idle.append(mb)
+        self.semaphore.release()
+
+    def discard(self, mb):
+        # Drop a connection that failed, a new one is opened by the next acquire().
+        try:
+            mb.box.shutdown()
+        except Exception:  # noqa the connection is already broken, nothing more to do
+            pass
+        self.semaphore.release()
+
+    async def close(self):
+        while self.idle:
+            mb = self.idle.pop()
+            try:
+                await asyncio.to_thread(mb.logout)
+            except retry_errors as e:
+                logging.warning('Logout from %s failed: %s', self.account['server'], e)
+
+
+async def run_with_retry(pool, folder, operation):
+    # Run operation(mb) on a pooled connection with folder selected.  Failed attempts are retried on a new connection
+    # after an exponential backoff of cfg.Mailboxes.backoff, 2 x backoff, 4 x backoff, ... seconds.
+    def select_and_run(mb):
+        if mb.folder.get() != folder:
+            mb.folder.set(folder)
+        return operation(mb)
+
+    for attempt in range(cfg.Mailboxes.retries + 1):
+        mb = await pool.acquire()
+        try:
+            result = await asyncio.to_thread(select_and_run, mb)
+        except retry_errors as e:
+            pool.discard(mb)
+            if attempt == cfg.Mailboxes.retries:
+                raise
+            delay = cfg.Mailboxes.backoff * 2 ** attempt
+            logging.warning('%s/%s failed (%r), retrying in %s seconds.', pool.account['server'], folder, e, delay)
+            await asyncio.sleep(delay)
+        else:
+            pool.release(mb)
+            return result
+
+
+async def parse_messages(executor, parse_batch, messages):
+    # Run the CPU stage for one batch in the process pool, cfg.Parse.chunk_size forms per task, keeping the order.
+    # Messages found in the parse cache already carry their fields and are not parsed.
+    loop = asyncio.get_running_loop()
+    htmls = [msg.html for msg in messages if msg.fields is None]
+    size = cfg.Parse.chunk_size
+    chunks = [htmls[start:start + size] for start in range(0, len(htmls), size)]
+    results = await asyncio.gather(*(loop.run_in_executor(executor, parse_batch, chunk) for chunk in chunks))
+    return [fields for chunk in results for fields in chunk]
+
+
+async def ingest_folder(pool, folder, state, executor, parse_batch, write_batch, cache):
+    account = pool.account
+    key = mailbox_key(account['server'], account['user'], folder)
+    uids, checkpoint = await run_with_retry(pool, folder,
+                                            lambda mb: find_new_uids(mb, folder, state, key, cfg.Sync.state_file))
+    fetch_batches = fetch_html_batches if cfg.Mail.lean_fetch else fetch_message_batches
+    batch_size = account.get('batch_size', cfg.Mail.batch_size)
+    cached = cache.mailbox(key, checkpoint['uidvalidity']) if cache is not None else None
+
+    async def fetch_and_parse(batch):
+        messages = await run_with_retry(
+            pool, folder,
+            lambda mb: next(fetch_batches(mb, batch, len(batch), mark_seen=False, cached=cached)))
+        with metrics.timed('parse'):
+            return messages, await parse_messages(executor, parse_batch, messages)
+
+    # At most pool.size batches of this folder are in flight, finished ones are written in order.
+    in_flight = deque()
+    try:
+        for start in range(0, len(uids), batch_size):
+            in_flight.append(asyncio.create_task(fetch_and_parse(uids[start:start + batch_size])))
+            if len(in_flight) >= pool.size:
+                write_batch(checkpoint, *await in_flight.popleft())
+        while in_flight:
+            write_batch(checkpoint, *await in_flight.popleft())
+    finally:
+        for task in in_flight:
+            task.cancel()
+    return checkpoint
+
+
+async def ingest_account(account, state, executor, parse_batch, write_batch, finish_checkpoint, cache):
+    pool = ImapConnectionPool(account)
+    try:
+        tasks = [ingest_folder(pool, folder, state, executor, parse_batch, write_batch, cache)
+                 for folder in account.get('folders', ['INBOX'])]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await pool.close()
+    # folders that were read completely are finished even if another folder of the account failed
+    for result in results:
+        if not isinstance(result, BaseException):
+            finish_checkpoint(result)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def ingest_mailboxes(accounts, state, executor, parse_batch, write_batch, finish_checkpoint, cache=None):
+    # Read every folder of every account concurrently.  parse_batch(htmls) extracts the fields of a list of forms,
+    # write_batch(checkpoint, messages, fields) writes the applicants of the messages and advances the checkpoint,
+    # finish_checkpoint() records a folder as completely processed.  cache is the parse_cache.ParseCache, if any.  A
+    # mailbox that keeps failing does not stop the others; the first error is raised once all of them are done.
+    results = await asyncio.gather(
+        *(ingest_account(account, state, executor, parse_batch, write_batch, finish_checkpoint, cache)
+          for account in accounts),
+        return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    for account, result in zip(accounts, results):
+        if isinstance(result, BaseException):
+            logging.error('Ingestion of %s@%s failed: %r', account['user'], account['server'], result)
+    if errors:
+        raise errors[0]
@@ -0,0 +1,308 @@
+from email.message import EmailMessage
+from form_extractor import extract_fields, extract_fields_bs4, scan_fields, LayoutError
+from imap_fetch import connect_mailbox, search_uids, registration_search_criteria, fetch_html_batches, \
+    fetch_message_batches
+from local_imap import LocalImapServer, message_bodystructure
+from mail_sources import archive_batches
+from parse_cache import ParseCache
+from process_applicant_registrations import normalize_fields, normalize_batch
+from results_export import ResultsExport
+import argparse
+import config as cfg
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# Benchmarks for the registration form pipeline.
+#
+#     python benchmark.py [--forms 2000] [--output results.json] [--write-mbox corpus.mbox]
+#
+# A corpus of synthetic emailmeform registrations is generated and every stage of the pipeline is timed on its own:
+# fetching from an IMAP server (the local_imap.py stand-in, lean and full fetch), reading an mbox archive, table
+# extraction (BeautifulSoup and the streaming scanner), normalization and the csv export.  Each stage runs in a forked
+# child process so its peak RSS is measured on its own.  The results are printed as JSON, one object per run, so
+# messages/second and peak RSS can be compared from release to release.
+#
+# Before timing anything the extraction code is checked against the original BeautifulSoup loop: every generated
+# form, plus a set of awkward layouts, has to produce exactly the same (label, value) pairs.  The script exits with
+# status 1 if it does not.
+
+# Labels of the fields on the form.  The computed columns use their column name as label, and PO boxes are entered
+# in the Street Address field.
+form_labels = [label for label, column in cfg.Header.fields.items() if label != column and label != 'PO Box']
+
+# Layouts the scanner has to reject or handle exactly like BeautifulSoup.
+awkward_forms = [
+    '<table><tr><td>First Name*:</td><td>Ann &amp; Bo&nbsp;</td></tr><tr><td>City*:</td><td><b>Peoria</b><br>'
+    '</td></tr></table>',
+    '<!-- <table><tr><td>x*:</td></tr></table> --><table><tr><td>State*:</td><td>il</td></tr></table>',
+    '<table><tr><td>Exams*:</td><td><table><tr><td>Element 2</td></tr></table></td></tr></table>',
+    '<table><tr><td>Phone*:<td>555-1212</tr></table>',
+    '<table><tr><td>Email*:</td><td>a@b.org<!-- note --></td></tr></table>',
+    '<TABLE><TBODY><TR><TH>Field</TH><TD>Suffix*:</TD><TD>NONE</TD><TD>Jr</TD></TR></TBODY></TABLE><table><tr>'
+    '<td>ignored*:</td></tr></table>',
+    '<html><head><style>td {color: red}</style><script>var t = "<table>";</script></head><body><table><tr>'
+    '<td>Zip Code*:</td><td> 61601 </td></tr></table></body></html>',
+]
+
+first_names = ['John', 'Mary', 'José', 'Li', 'Anne-Marie', 'Bob']
+last_names = ['Doe', "O'Brien", 'Smith-Jones', 'Nguyen', 'Müller', 'Van Der Berg']
+middle_initials = ['NONE', 'none', 'None', 'Q', 'J.', '']
+suffixes = ['NONE', 'none', 'Jr', 'Sr.', 'III']
+streets = ['12 Main St', '4 Elm &amp; Oak Ave', '1600 N. Prospect Rd Apt 3']
+po_boxes = ['PO Box 7', 'PO BOX 1234', 'P.O. Box 55']
+cities = ['peoria', 'CHICAGO', 'East Peoria', 'sT. lOUIS']
+states = ['il', 'IN', 'Wi', 'MO']
+callsigns = ['NOCALL', 'nocall', 'kd9abc', 'N9AG', 'W9xyz']
+bad_callsigns = ['K D9XYZ', 'kd9-abc', 'KD9ABC/AG', 'n/a']
+exams = ['Element 2 (Technician)', 'Element 3 (General)', 'Element 4 (Amateur Extra)']
+
+
+def generate_values(rnd, number):
+    # Field values for one applicant, covering the cases the normalization has to deal with.
+    exam_count = rnd.choice([1, 1, 1, 2, 3])
+    first = rnd.randrange(len(exams) - exam_count + 1)
+    values = {
+        'First Name': rnd.choice(first_names),
+        'Middle Initial': rnd.choice(middle_initials),
+        'Last Name': f'{rnd.choice(last_names)}{number}',
+        'Suffix': rnd.choice(suffixes),
+        'Street Address': rnd.choice(po_boxes) if rnd.random() < 0.2 else rnd.choice(streets),
+        'City': rnd.choice(cities),
+        'State': rnd.choice(states),
+        'Zip Code': f'{rnd.randint(0, 99999):05d}',
+        'Phone': f'309-555-{rnd.randint(0, 9999):04d}',
+        'Email': f'applicant{number}@example.org',
+        'FCC FRN Number': f'{rnd.randint(0, 9999999999):010d}',
+        'Callsign': rnd.choice(bad_callsigns) if rnd.random() < 0.1 else rnd.choice(callsigns),
+        'Exams': ', '.join(exams[first:first + exam_count]),
+        'Felony Conviction': rnd.choice(['No', 'No', 'No', 'Yes']),
+    }
+    return {label: values.get(label, '') for label in form_labels}
+
+
+def generate_form_html(rnd, number):
+    # A registration form in the emailmeform html table layout.
+    values = generate_values(rnd, number)
+    rows = ''.join(f'<tr>\n<td style="font-weight:bold" width="30%">{label}*:</td>\n<td>&nbsp;{values[label]}</td>\n'
+                   f'</tr>\n' for label in form_labels)
+    return ('<html><head><meta charset="utf-8"><style type="text/css">td {font-family: Arial}</style></head>'
+            '<body><p>You have received a new submission.</p>'
+            f'<table cellpadding="4" border="1">\n<tbody>\n{rows}</tbody>\n</table>'
+            '<p>Powered by emailmeform</p></body></html>')
+
+
+def generate_form_email(rnd, number):
+    # A complete registration email: plain text and html alternatives in varying transfer encodings, and now and
+    # then an attachment the applicant added to the submission.
+    html = generate_form_html(rnd, number)
+    msg = EmailMessage()
+    msg['From'] = 'EmailMeForm <burst@emailmeform.com>'
+    msg['To'] = 'registrations@example.org'
+    msg['Subject'] = f'New submission - Exam session registration #{number}'
+    msg['Date'] = (datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+                   + datetime.timedelta(minutes=number)).strftime('%a, %d %b %Y %H:%M:%S %z')
+    msg['Message-ID'] = f'<registration-{number}@emailmeform.com>'
+    msg.set_content('You have received a new submission, please view it in an html capable mail reader.')
+    msg.add_alternative(html, subtype='html', cte=rnd.choice(['quoted-printable', 'base64', '8bit']))
+    if rnd.random() < 0.1:
+        msg.add_attachment(rnd.randbytes(rnd.randint(50000, 200000)), maintype='application', subtype='pdf',
+                           filename='license.pdf')
+    return msg.as_bytes()
+
+
+def write_mbox(path, emails):
+    with open(path, 'wb') as f:
+        for raw in emails:
+            raw = raw.replace(b'\r\n', b'\n').replace(b'\nFrom ', b'\n>From ')
+            f.write(b'From burst@emailmeform.com Mon Jan  1 00:00:00 2024\n' + raw + b'\n')
+
+
+def check_extraction(forms):
+    # Compare the new extraction path with the original BeautifulSoup loop.  Returns the number of mismatches.
+    mismatches = 0
+    for html in forms + awkward_forms:
+        if extract_fields(html) != extract_fields_bs4(html):
+            mismatches += 1
+            print(f'MISMATCH: {html[:200]}', file=sys.stderr)
+    return mismatches
+
+
+def measure(function, *args):
+    # Run function(*args) in a forked child and return its timing.  function returns the number of messages it
+    # handled and the number of bytes it read.
+    def child(connection):
+        start = time.perf_counter()
+        messages, size = function(*args)
+        seconds = time.perf_counter() - start
+        connection.send({
+            'messages': messages,
+            'seconds': round(seconds, 4),
+            'messages_per_second': round(messages / seconds, 1) if seconds else None,
+            'bytes': size,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(sender,))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def stage_fetch(server, batch_fetch, cache_file=None):
+    # The bytes sent are counted by the server in the parent process, see measure_fetch().  With cache_file the
+    # forms are looked up in that parse cache by Message-ID; its mailbox view has no uidvalidity, so no lookup hits by
+    # uid and every run measures the same thing.
+    mb = connect_mailbox('127.0.0.1', server.user, server.password, port=server.port, ssl=False)
+    uids = search_uids(mb, registration_search_criteria())
+    cache = ParseCache(cache_file, cfg.Cache.max_bytes) if cache_file else None
+    cached = cache.mailbox('benchmark', None) if cache is not None else None
+    count = 0
+    for messages in batch_fetch(mb, uids, cfg.Mail.batch_size, mark_seen=False, cached=cached):
+        count += sum(1 for msg in messages if msg.html or msg.fields)
+    mb.logout()
+    if cache is not None:
+        cache.close()
+    return count, None
+
+
+def fill_parse_cache(cache_file, mbox_path):
+    cache = ParseCache(cache_file, cfg.Cache.max_bytes)
+    checkpoint = {'key': 'benchmark', 'uidvalidity': None}
+    for messages in archive_batches('mbox', mbox_path, cfg.Mail.batch_size):
+        for msg in messages:
+            cache.add(checkpoint, msg, extract_fields(msg.html))
+    cache.close()
+
+
+def measure_fetch(server, batch_fetch, cache_file=None):
+    sent = server.bytes_sent
+    result = measure(stage_fetch, server, batch_fetch, cache_file)
+    result['bytes'] = server.bytes_sent - sent
+    return result
+
+
+def stage_archive(path):
+    count = 0
+    for messages in archive_batches('mbox', path, cfg.Mail.batch_size):
+        count += sum(1 for msg in messages if msg.html)
+    return count, os.path.getsize(path)
+
+
+def stage_extract(function, forms):
+    for html in forms:
+        function(html)
+    return len(forms), sum(len(html) for html in forms)
+
+
+def stage_normalize(normalize, extracted):
+    for fields in extracted:
+        normalize(fields)
+    return len(extracted), 0
+
+
+def stage_normalize_batch(extracted):
+    for start in range(0, len(extracted), cfg.Mail.batch_size):
+        normalize_batch(extracted[start:start + cfg.Mail.batch_size])
+    return len(extracted), 0
+
+
+def stage_csv_export(applicants):
+    export = ResultsExport(cfg.Export.journal_file, lambda checkpoint, uid: None)
+    export.open()
+    for start in range(0, len(applicants), cfg.Mail.batch_size):
+        export.write(applicants[start:start + cfg.Mail.batch_size])
+    export.finish()
+    return len(applicants), os.path.getsize(export.csv_filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the registration form pipeline.')
+    parser.add_argument('--forms', type=int, default=2000, help='number of synthetic registrations')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic corpus')
+    parser.add_argument('--output', help='append the JSON results to this file instead of printing them')
+    parser.add_argument('--write-mbox', help='also save the synthetic corpus as an mbox file')
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+
+    rnd = random.Random(args.seed)
+    emails = [generate_form_email(rnd, number) for number in range(args.forms)]
+    forms = [generate_form_html(random.Random(number), number) for number in range(args.forms)]
+    if args.write_mbox:
+        write_mbox(args.write_mbox, emails)
+
+    mismatches = check_extraction(forms)
+    if mismatches:
+        print(f'{mismatches} forms did not match the BeautifulSoup reference.', file=sys.stderr)
+        return 1
+
+    workdir = tempfile.mkdtemp(prefix='registration_benchmark_')
+    cwd = os.getcwd()
+    # the csv export stage writes its file and journal into the current directory
+    os.chdir(workdir)
+
+    extracted = [extract_fields(html) for html in forms]
+    applicants = [normalize_fields(fields) for fields in extracted]
+    mbox_path = os.path.join(workdir, 'corpus.mbox')
+    write_mbox(mbox_path, emails)
+    cache_file = os.path.join(workdir, 'parse_cache.sqlite3')
+    fill_parse_cache(cache_file, mbox_path)
+
+    stages = {}
+    with LocalImapServer() as server:
+        for raw in emails:
+            server.add_message(raw)
+            # warm the stand-in's parse cache, so the fetch stages time the client and not the Python server
+            message_bodystructure(raw)
+        stages['fetch_lean'] = measure_fetch(server, fetch_html_batches)
+        stages['fetch_full'] = measure_fetch(server, fetch_message_batches)
+        stages['fetch_lean_cached'] = measure_fetch(server, fetch_html_batches, cache_file)
+    stages['archive_mbox'] = measure(stage_archive, mbox_path)
+    stages['extract_bs4'] = measure(stage_extract, extract_fields_bs4, forms)
+    stages['extract_scanner'] = measure(stage_extract, extract_fields, forms)
+    stages['normalize'] = measure(stage_normalize, normalize_fields, extracted)
+    stages['normalize_batch'] = measure(stage_normalize_batch, extracted)
+    stages['csv_export'] = measure(stage_csv_export, applicants)
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+
+    scanned = 0
+    for html in forms:
+        try:
+            scan_fields(html)
+            scanned += 1
+        except LayoutError:
+            pass
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'forms': args.forms,
+        'seed': args.seed,
+        'batch_size': cfg.Mail.batch_size,
+        'scanner_layout_hits': scanned,
+        'stages': stages,
+    }
+    if output:
+        with open(output, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+    else:
+        print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import argparse
+import config as cfg
+import datetime
+import logging
+import os
+import signal
+import sys
+
+# Command line of the registration pipeline.
+#
+#     python cli.py fetch [--source mbox --path forms.mbox] [--profile FILE] [--trace-memory [N]]
+#     python cli.py serve
+#     python cli.py export [--since 2024-06-01] [--before 2024-06-08] [--session 2024-06-15] [--output june.csv]
+#     python cli.py validate [import files]
+#     python cli.py dry-run [--count]
+#
+# fetch (or run) reads the new registration forms and writes the import files, serve keeps doing so as new forms
+# arrive, see process_applicant_registrations.py.  export rebuilds an import file from the applicant store without
+# reading mail.  validate checks config.py, and the header and row length of import files.  dry-run shows what the
+# next fetch would do: where the checkpoint of every source stands, whether an interrupted export is resumed and which
+# files the rows go to.  It writes nothing and does not log in unless --count asks for the number of new forms.
+#
+# Schedulers and hooks run these commands every minute, so each command imports the modules it needs when it runs.
+# export, validate and dry-run start without loading imap_tools, BeautifulSoup, asyncio or the process pool, and
+# only fetch and serve open a trace log file.
+
+
+def fetch(args):
+    import metrics
+    from process_applicant_registrations import main as run
+    from trace_logging import start_logging, stop_logging
+    serve = args.command == 'serve'
+    if serve:
+        # stop the same way on SIGTERM as on Ctrl-C, the export is kept for the next run
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    log_listeners = start_logging()
+    try:
+        logging.info('%s ===================================', datetime.datetime.now())
+        logging.info('Application export process starting')
+
+        with metrics.profiling(args.profile, args.trace_memory):
+            run(getattr(args, 'source', None), getattr(args, 'path', None), serve=serve)
+        logging.info('Application export process completed.')
+        logging.info('%s ===================================', datetime.datetime.now())
+    except KeyboardInterrupt:
+        logging.info('Application export process stopped.')
+    except Exception:
+        logging.exception('Application export process failed.')
+        raise
+    finally:
+        stop_logging(log_listeners)
+    return 0
+
+
+def export(args):
+    from applicant_store import ApplicantStore
+    if not os.path.exists(args.database):
+        print(f'Applicant store {args.database} does not exist.', file=sys.stderr)
+        return 1
+    output = args.output or datetime.datetime.now().strftime("%m%d%Y_%H%M%S") + "_session_import.csv"
+    store = ApplicantStore(args.database)
+    try:
+        count = store.export(output, args.since, args.before, args.session)
+    finally:
+        store.close()
+    print(f'Exported {count} applicants to {output}.')
+    return 0
+
+
+def config_problems():
+    # Mistakes in config.py that would stop a run or make it write wrong rows.
+    from applicant import label_position
+    from normalization import compile_rules, rule_functions
+    from session_routing import SessionRouter
+    problems = []
+    labels = set(label_position)
+    for label, name in cfg.Header.rules.items():
+        other_labels = rule_functions[name][1] if name in rule_functions else ()
+        for missing in [label, *other_labels]:
+            if missing not in labels:
+                problems.append(f'cfg.Header.rules: rule {name} of {label!r} sets {missing!r}, which is not in '
+                                f'cfg.Header.fields.')
+    if not problems:
+        try:
+            compile_rules(cfg.Header.rules)
+        except ValueError as e:
+            problems.append(f'cfg.Header.rules: {e}')
+    for alias, label in cfg.Header.aliases.items():
+        if label not in labels and label not in cfg.Header.ignored:
+            problems.append(f'cfg.Header.aliases: {alias!r} stands for {label!r}, which is not in cfg.Header.fields.')
+    for label in cfg.Header.required:
+        if label not in labels:
+            problems.append(f'cfg.Header.required: {label!r} is not in cfg.Header.fields.')
+    if not cfg.VE.team:
+        problems.append('cfg.VE.team is empty.')
+    for name, session in cfg.Sessions.sessions.items():
+        if not session.get('ves'):
+            problems.append(f'cfg.Sessions.sessions: session {name!r} has no VE team.')
+    try:
+        SessionRouter(cfg.Sessions.sessions, cfg.Sessions.field)
+    except (KeyError, ValueError, TypeError) as e:
+        problems.append(f'cfg.Sessions.sessions: {e!r}')
+    if cfg.Source.kind != 'imap':
+        from mail_sources import SOURCE_KINDS
+        if cfg.Source.kind not in SOURCE_KINDS:
+            problems.append(f'cfg.Source.kind {cfg.Source.kind!r} is not one of {", ".join(SOURCE_KINDS)}.')
+        elif not os.path.exists(cfg.Source.path):
+            problems.append(f'cfg.Source.path {cfg.Source.path!r} does not exist.')
+    if cfg.Uls.dump_dir and not os.path.isdir(cfg.Uls.dump_dir):
+        problems.append(f'cfg.Uls.dump_dir {cfg.Uls.dump_dir!r} is not a directory.')
+    for setting, filename in (('cfg.Metrics.textfile', cfg.Metrics.textfile),
+                              ('cfg.Metrics.json_file', cfg.Metrics.json_file)):
+        if filename and not os.path.isdir(os.path.dirname(filename) or '.'):
+            problems.append(f'{setting}: directory of {filename!r} does not exist.')
+    return problems
+
+
+def import_file_problems(filename):
+    # An import file has to start with the column header of cfg.Header.fields and hold a full row per applicant.
+    import csv
+    from applicant import columns
+    with open(filename, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        if tuple(next(reader, ())) != columns:
+            return [f'{filename}: header does not match the columns of cfg.Header.fields.']
+        return [f'{filename}: row {row} has {len(values)} columns instead of {len(columns)}.'
+                for row, values in enumerate(reader, 1) if len(values) != len(columns)]
+
+
+def validate(args):
+    problems = config_problems()
+    for filename in args.files:
+        problems += import_file_problems(filename)
+    for problem in problems:
+        print(problem)
+    if problems:
+        return 1
+    print('Configuration' + (' and import files' if args.files else '') + ' OK.')
+    return 0
+
+
+def mailbox_sources():
+    # (key, account, folder) of every mailbox folder a fetch reads.
+    from sync_state import mailbox_key
+    if cfg.Mailboxes.accounts:
+        return [(mailbox_key(account['server'], account['user'], folder), account, folder)
+                for account in cfg.Mailboxes.accounts for folder in account.get('folders', ['INBOX'])]
+    account = {'server': cfg.Mail.server, 'user': cfg.Mail.user, 'password': cfg.Mail.password,
+               'port': cfg.Mail.port, 'ssl': cfg.Mail.ssl}
+    return [(mailbox_key(cfg.Mail.server, cfg.Mail.user, cfg.Mail.folder), account, cfg.Mail.folder)]
+
+
+def count_new_forms(account, folder, state, key):
+    from imap_fetch import connect_mailbox
+    from sync_state import find_new_uids
+    mb = connect_mailbox(account['server'], account['user'], account['password'], folder=folder,
+                         port=account.get('port', 993), ssl=account.get('ssl', True))
+    try:
+        return len(find_new_uids(mb, folder, state, key)[0])
+    finally:
+        mb.logout()
+
+
+def dry_run(args):
+    from results_export import archive_key, load_journal
+    from sync_state import load_sync_state
+    state = load_sync_state(cfg.Sync.state_file)
+    journal = load_journal(cfg.Export.journal_file)
+    progress = {}
+    if journal is not None:
+        progress = journal['progress']
+        files = journal['files'].values() if 'files' in journal else [journal]
+        for entry in files:
+            print(f'Resumes the export to {entry["csv_file"]} after {entry["rows"]} applicants.')
+    else:
+        print('Starts a new import file.')
+
+    if cfg.Source.kind != 'imap':
+        key = archive_key(cfg.Source.kind, cfg.Source.path)
+        handled = set(progress.get(key, {}).get('handled', ()))
+        print(f'Reads the {cfg.Source.kind} archive {cfg.Source.path}, skipping {len(handled)} forms written before.')
+        if args.count:
+            from imap_fetch import FORM_SENDER
+            from imap_tools.message import MailMessage
+            from mail_sources import archive_uid, iter_archive
+            count = 0
+            for raw in iter_archive(cfg.Source.kind, cfg.Source.path):
+                msg = MailMessage.from_bytes(raw)
+                count += msg.from_.lower() == FORM_SENDER and archive_uid(msg, raw) not in handled
+            print(f'  {count} new forms.')
+    for key, account, folder in mailbox_sources() if cfg.Source.kind == 'imap' else ():
+        checkpoint = state.get(key)
+        position = progress.get(key)
+        if position is not None and (checkpoint is None or checkpoint['uidvalidity'] != position['uidvalidity']
+                                     or checkpoint['last_uid'] < position['last_uid']):
+            checkpoint = position
+        if checkpoint is None:
+            print(f'Reads {key}: no checkpoint, the unseen forms are read.')
+        else:
+            print(f'Reads {key} after UID {checkpoint["last_uid"]} (UIDVALIDITY {checkpoint["uidvalidity"]}).')
+        if args.count:
+            if checkpoint is not None:
+                state[key] = checkpoint
+            print(f'  {count_new_forms(account, folder, state, key)} new forms.')
+
+    for name, session in cfg.Sessions.sessions.items():
+        print(f'Session {name}: VEs {", ".join(session["ves"])}.')
+    print(f'Applicants without a session: VEs {", ".join(cfg.VE.team)}.')
+    for setting, value in (('Applicant store', cfg.Store.database), ('Duplicate index', cfg.Dedup.index_file),
+                           ('Parse cache', cfg.Cache.cache_file), ('ULS dumps', cfg.Uls.dump_dir),
+                           ('Quarantine', cfg.Quarantine.directory), ('Metrics text file', cfg.Metrics.textfile),
+                           ('Metrics JSON', cfg.Metrics.json_file)):
+        print(f'{setting}: {value or "off"}')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export applicant registration forms for Session Manager.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, aliases, help_text in (('fetch', ['run'], 'process the new registration forms once'),
+                                     ('serve', [], 'keep processing new registration forms as they arrive')):
+        command = commands.add_parser(name, aliases=aliases, help=help_text)
+        if name == 'fetch':
+            command.add_argument('--source', help='imap, mbox, maildir or eml (default: cfg.Source.kind)')
+            command.add_argument('--path', help='archive to read (default: cfg.Source.path)')
+        command.add_argument('--profile', metavar='FILE',
+                             help='profile the run with cProfile and save the stats to FILE')
+        command.add_argument('--trace-memory', metavar='N', type=int, nargs='?', const=20, default=0,
+                             help='trace memory allocations with tracemalloc and log the top N allocators '
+                                  '(default 20)')
+        command.set_defaults(function=fetch)
+    command = commands.add_parser('export', help='rebuild an import file from the applicant store')
+    command.add_argument('--database', default=cfg.Store.database, help='store to read (default: %(default)s)')
+    command.add_argument('--since', type=datetime.date.fromisoformat, help='first day of receipt, YYYY-MM-DD')
+    command.add_argument('--before', type=datetime.date.fromisoformat, help='day after the last day of receipt')
+    command.add_argument('--session', help='only applicants registered for this exam session')
+    command.add_argument('--output', help='file to write (default: a new timestamped _session_import.csv)')
+    command.set_defaults(function=export)
+    command = commands.add_parser('validate', help='check config.py and import files')
+    command.add_argument('files', nargs='*', help='import files to check')
+    command.set_defaults(function=validate)
+    command = commands.add_parser('dry-run', help='show what the next fetch would do, without doing it')
+    command.add_argument('--count', action='store_true', help='log in and count the new forms')
+    command.set_defaults(function=dry_run)
+    args = parser.parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
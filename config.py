@@ -1,13 +1,159 @@
 class Mail:
     server = 'server'
+    port = 993
+    # Set to False for a server without TLS, such as the local_imap.py stand-in.
+    ssl = True
     user = 'username'
     password = 'password'
+    folder = 'INBOX'
+    # Number of registration forms pulled from the server per FETCH command.  Larger batches mean fewer round
+    # trips, smaller batches keep less mail in memory at once.
+    batch_size = 50
+    # Download only the text/html part of each form instead of the complete message.  Saves the headers, the plain
+    # text copy and any attachments from being transferred.
+    lean_fetch = True
+
+
+class Source:
+    # Where registration forms are read from: 'imap' logs into the mail server(s), 'mbox', 'maildir' and 'eml' read
+    # an archive at path instead (an mbox file, a Maildir tree or a directory of .eml files) without touching the
+    # server or the sync checkpoints.
+    kind = 'imap'
+    path = ''
+
+
+class Search:
+    # Extra server side search criteria for registration forms, None disables a criterion.
+    # since and before are datetime.date values, e.g. datetime.date(2024, 1, 31), before is exclusive.
+    since = None
+    before = None
+    subject = None
+
+
+class Mailboxes:
+    # Intake mailboxes read concurrently into a single export.  Leave accounts empty to read only the mailbox in
+    # Mail.  Each account is a dict, for example:
+    #     {'server': 'imap.example.org', 'user': 'site1', 'password': 'secret', 'folders': ['INBOX'],
+    #      'concurrency': 2}
+    # concurrency is the number of IMAP connections kept open to the account (default 2), port (default 993), ssl
+    # (default True) and batch_size (default Mail.batch_size) are optional as well.
+    accounts = []
+    # Failed IMAP commands are retried this many times on a new connection, waiting backoff, 2 x backoff,
+    # 4 x backoff, ... seconds in between.
+    retries = 3
+    backoff = 2.0
+
+
+class Parse:
+    # Number of worker processes that parse and normalize forms, None uses one per CPU and 1 parses in the main
+    # process without a pool.
+    workers = None
+    # Number of forms handed to a worker at a time.
+    chunk_size = 8
+
+
+class Sync:
+    # File used to remember the highest processed message UID of each mailbox between runs.
+    state_file = 'sync_state.json'
+
+
+class Export:
+    # The import file is written as '<name>.part' and renamed to <name> when the run completes.  The part file is
+    # flushed to disk every sync_interval seconds (0 after every batch); mailbox checkpoints only move forward once
+    # the rows they cover are on disk.
+    sync_interval = 5.0
+    # Journal of an unfinished export.  If a run stops early the next run resumes the export described here.
+    journal_file = 'export_journal.json'
+
+
+class Store:
+    # SQLite database that keeps every exported applicant, so import files for any date range or session can be
+    # rebuilt later with 'python applicant_store.py export' without reading mail again.  None disables the store.
+    database = 'applicants.sqlite3'
+    # Exam session the applicants of a run register for, e.g. '2024-06-15'.  Stored with each applicant so
+    # 'export --session' can select them, None leaves the session empty.
+    session = None
+
+
+class Dedup:
+    # Index of the identity (FRN, else e-mail + last name + ZIP code) of every exported applicant, used to catch
+    # registration forms submitted more than once.  The latest submission is kept, duplicates are listed in
+    # '<import file>_duplicates.csv'.  None turns duplicate detection off.
+    index_file = 'applicant_identities.sqlite3'
+
+
+class Cache:
+    # On-disk cache of the fields extracted from each registration form, see parse_cache.py.  Forms found in the
+    # cache are neither downloaded nor parsed again.  max_bytes limits the size of the cached fields, least recently
+    # used forms are evicted first.  None turns the cache off.
+    cache_file = 'parse_cache.sqlite3'
+    max_bytes = 64 * 1024 * 1024
+
+
+class Quarantine:
+    # Directory that receives the forms of unknown layouts, one JSON file per message with its fields and html.  None
+    # only logs and skips them.
+    directory = 'quarantine'
+
+
+class Uls:
+    # Directory of FCC ULS amateur license dumps, see uls_index.py.  When set, every applicant's callsign, FRN and
+    # name are checked against the licenses in the dumps and UPGRADE_LICENSE is set from the license the applicant
+    # holds.  None turns the check off.
+    dump_dir = None
+    index_file = 'uls_amateur.idx'
+    # File names of the weekly full dump and of the daily transaction files.
+    full_dump = 'l_amat.zip'
+    daily_dump = 'l_am_*.zip'
+
+
+class Serve:
+    # serve mode, see process_applicant_registrations.py.  The connection to cfg.Mail waits for new forms with IMAP
+    # IDLE for up to idle_timeout seconds at a time, then checks the folder again.  Every reconnect_interval seconds
+    # it logs out and back in.  A lost connection is retried after backoff seconds, doubling up to max_backoff.
+    idle_timeout = 300
+    reconnect_interval = 3600
+    backoff = 5
+    max_backoff = 300
+
+
+class Logging:
+    # Trace log level: 'DEBUG' traces every field of every form, 'INFO' logs the progress of the run and 'WARNING'
+    # only problems.  Tracing every field slows down large runs noticeably.
+    level = 'INFO'
+    # 'text' for the readable log, 'jsonl' for one compact JSON object per record.
+    format = 'text'
+    # Trace log file name, strftime codes are replaced with the start time of the run.
+    filename = '%m%d%Y_%H%M%S_script_trace.log'
+
+
+class Metrics:
+    # Per-stage timers and counters of a run, see metrics.py.  A summary is logged when the run ends.  textfile
+    # writes them in the Prometheus text format, e.g. into the directory of the node exporter textfile collector
+    # ('/var/lib/node_exporter/textfile_collector/registrations.prom'), json_file as JSON.  In serve mode both are
+    # updated after every round of new forms.  None turns a file off.
+    textfile = None
+    json_file = None
+    # Prefix of the Prometheus metric names.
+    prefix = 'registration_export'
 
 
 class VE:
-    one = 'callsign_one'
-    two = 'callsign_two'
-    three = 'callsign_three'
+    # Certifying VEs of the applicants that are not routed to one of cfg.Sessions.sessions, any number of callsigns.
+    team = ['callsign_one', 'callsign_two', 'callsign_three']
+
+
+class Sessions:
+    # Exam sessions to route applicants to, each with its own import file and VE team, see session_routing.py.
+    # field is the label of the form field in which applicants pick their session, None if the form has none.
+    # Example:
+    #   sessions = {
+    #       '2024-06-15 Peoria': {'ves': ['K9ABC', 'N9XYZ', 'W9QQQ', 'KD9AAA'], 'match': ['June 15 - Peoria'],
+    #                             'since': '2024-05-16', 'before': '2024-06-15'},
+    #   }
+    # Empty writes every applicant to one import file with the VE team of cfg.VE.
+    field = None
+    sessions = {}
 
 
 class Header:
@@ -33,4 +179,26 @@ class Header:
         'PREVIOUS_APPLICATION': 'PREVIOUS_APPLICATION',
         'CERTIFYING_VES': 'CERTIFYING_VES',
     }
+
+    # Clean up rule of each form label, see normalization.py for the available rules.  Labels without a rule are
+    # written as the applicant entered them.
+    rules = {
+        'Middle Initial': 'none_to_empty',
+        'Suffix': 'none_to_empty',
+        'Street Address': 'po_box',
+        'City': 'capitalize',
+        'State': 'upper',
+        'Callsign': 'callsign',
+        'Exams': 'exams',
+    }
+
+    # Labels of other versions of the form, mapped to the label of fields above they stand for.
+    aliases = {}
+
+    # Labels that are read from the form but not written to the import file.  cfg.Sessions.field is always one.
+    ignored = ()
+
+    # Labels a form must have to be imported.  Forms of a layout without them, or with labels that are neither in
+    # fields nor in aliases, are moved to cfg.Quarantine.directory.
+    required = ('First Name', 'Last Name', 'Email')
     
@@ -0,0 +1,203 @@
+from applicant import column_position
+from collections import namedtuple
+import hashlib
+import logging
+import metrics
+import re
+import sqlite3
+
+# Duplicate submission detection.  Applicants regularly send the registration form twice, for example to fix a typo.
+# Each applicant gets an identity: the FCC FRN, or if there is none, the e-mail address, last name and ZIP code.
+# The identity is hashed and looked up in a dict of everything seen in this run, so a form costs O(1), and in a
+# persistent SQLite index of the identities of earlier exports, which is queried once per batch.
+#
+# The latest submission of an identity wins.  An earlier submission in the same export, in any of its session files,
+# is dropped from its import file when the export is finalized; an earlier submission that was exported by a previous
+# run can not be taken back and is reported instead, so it can be corrected in Session Manager.  Every duplicate is
+# listed in '<import file>_duplicates.csv' next to the import files.
+#
+# A form that is read again, after a UIDVALIDITY change, from another intake mailbox or from an archive, is the same
+# message and not a resubmission.  It is left out, a second copy within one export is listed in the report as well.
+# Messages are recognized by their Message-ID, or by their (source, uidvalidity, uid) when the Message-ID is unknown.
+# The identities are written to the index with every commit of the export, so a resumed export knows the messages of
+# the rows it already holds.
+
+# A submission of an identity.  row is its row in its import file, export the name of that file, message its
+# Message-ID.  row is None for submissions of earlier exports.
+Submission = namedtuple('Submission', 'row received export source uidvalidity uid message')
+
+report_columns = ('FIRST_NAME', 'LAST_NAME', 'E_MAIL', 'FRN', 'action', 'kept_received', 'superseded_received',
+                  'superseded_export')
+
+FRN = column_position['FRN']
+E_MAIL = column_position['E_MAIL']
+LAST_NAME = column_position['LAST_NAME']
+FIRST_NAME = column_position['FIRST_NAME']
+ZIP_CODE = column_position['ZIP_CODE']
+non_alphanumeric = re.compile(r'\W+')
+non_digit = re.compile(r'\D+')
+
+
+def applicant_identity(applicant):
+    # Hashed identity of an applicant row, or None if the form holds neither an FRN nor an e-mail address.
+    frn = non_digit.sub('', str(applicant[FRN]))
+    if frn.strip('0'):
+        key = 'frn:' + frn.zfill(10)
+    else:
+        email = str(applicant[E_MAIL]).strip().lower()
+        if not email:
+            return None
+        last_name = non_alphanumeric.sub('', str(applicant[LAST_NAME]).casefold())
+        zip_code = non_digit.sub('', str(applicant[ZIP_CODE]))[:5]
+        key = f'contact:{email}|{last_name}|{zip_code}'
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+def same_message(submission, other):
+    # True if both submissions are the same message, read twice.
+    if submission.message is not None and submission.message == other.message:
+        return True
+    return other.source is not None and submission[3:6] == other[3:6]
+
+
+def is_older(submission, other):
+    # True if submission was received before other.  Submissions without a receipt time count as newer, which keeps
+    # the one processed last.
+    return submission.received is not None and other.received is not None and submission.received < other.received
+
+
+class DuplicateIndex:
+    def __init__(self, index_file):
+        self.connection = sqlite3.connect(index_file)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS identities (digest BLOB PRIMARY KEY, export TEXT, received TEXT, '
+                'source TEXT, uidvalidity INTEGER, uid INTEGER) WITHOUT ROWID')
+            # columns added after the index was created are added to the table
+            existing = {row[1] for row in self.connection.execute('PRAGMA table_info(identities)')}
+            for column, column_type in (('message', 'TEXT'), ('row', 'INTEGER')):
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE identities ADD COLUMN {column} {column_type}')
+        self.seen = {}
+        self.changed = set()
+        self.report = []
+
+    def resume(self, export):
+        # Rebuild the identities of a resumed export from the rows that are already in its files.  The index tells
+        # which message each row came from, unless the row was written after the last commit of the index.  Index
+        # entries of rows the interrupted run wrote after its last journal commit are gone from the files and are
+        # deleted, their forms are read again.
+        stale = []
+        for export_file in export.files.values():
+            stored = {digest: Submission(row, received, export_file.csv_filename, source, uidvalidity, uid, message)
+                      for digest, received, source, uidvalidity, uid, message, row in self.connection.execute(
+                          'SELECT digest, received, source, uidvalidity, uid, message, row FROM identities '
+                          'WHERE export = ?', (export_file.csv_filename,))}
+            for row, applicant in export_file.committed_rows():
+                digest = applicant_identity(applicant)
+                if digest is not None:
+                    submission = stored.get(digest)
+                    if submission is None or submission.row != row:
+                        submission = Submission(row, None, export_file.csv_filename, None, None, None, None)
+                        self.changed.add(digest)
+                    self.seen[digest] = submission
+            stale += [digest for digest, submission in stored.items() if self.seen.get(digest) is not submission]
+        with self.connection:
+            self.connection.executemany('DELETE FROM identities WHERE digest = ?', ((digest,) for digest in stale))
+        logging.info('Loaded %d identities of the resumed export.', len(self.seen))
+
+    def lookup(self, digests):
+        # Load the submissions of earlier exports for the identities of a batch that this run has not seen yet.
+        missing = [digest for digest in set(digests) if digest not in self.seen]
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            for digest, export, received, source, uidvalidity, uid, message in self.connection.execute(
+                    f'SELECT digest, export, received, source, uidvalidity, uid, message FROM identities '
+                    f'WHERE digest IN ({", ".join("?" * len(chunk))})', chunk):
+                self.seen[digest] = Submission(None, received, export, source, uidvalidity, uid, message)
+
+    def check(self, checkpoint, messages, applicants, export, session=None):
+        # Sort out the duplicates of the applicants of one batch for session before they are written to export.
+        # Returns the messages and applicants to write, and the (source, uidvalidity, uid, message) keys of the
+        # submissions that were superseded.
+        export_file = export.file(session)
+        source = checkpoint['key']
+        uidvalidity = checkpoint['uidvalidity'] or 0
+        digests = [applicant_identity(applicant) for applicant in applicants]
+        self.lookup(digest for digest in digests if digest is not None)
+
+        kept_messages = []
+        kept_applicants = []
+        superseded = []
+        for msg, applicant, digest in zip(messages, applicants, digests):
+            received = msg.received.isoformat(sep=' ', timespec='seconds') if msg.received else None
+            submission = Submission(export_file.rows + len(kept_applicants), received, export_file.csv_filename,
+                                    source, uidvalidity, int(msg.uid), msg.message_id)
+            earlier = self.seen.get(digest) if digest is not None else None
+            if earlier is not None and same_message(submission, earlier):
+                if earlier.row is not None:
+                    # a second copy of a form of this export, delivered twice or to two intake mailboxes
+                    self.add_report(applicant, 'second copy of the same message, left out', earlier, submission)
+                else:
+                    # a form of an earlier export read again, after a UIDVALIDITY change or from an archive
+                    logging.info('%s %s was exported to %s before, skipping the form.', applicant[FIRST_NAME],
+                                 applicant[LAST_NAME], earlier.export)
+                continue
+            if earlier is not None and is_older(submission, earlier):
+                # a newer submission is already exported, this one is left out
+                self.add_report(applicant, 'skipped, older than the submission kept', earlier, submission)
+                superseded.append(submission[3:])
+                continue
+            if earlier is not None:
+                earlier_file = export.find_file(earlier.export) if earlier.row is not None else None
+                if earlier_file is not None:
+                    earlier_file.drop(earlier.row)
+                    self.add_report(applicant, 'earlier submission removed from this import file', submission,
+                                    earlier)
+                else:
+                    logging.warning('%s %s resubmitted the registration form already exported to %s, update the '
+                                    'applicant in Session Manager.', applicant[FIRST_NAME], applicant[LAST_NAME],
+                                    earlier.export)
+                    self.add_report(applicant, 'earlier submission already imported, update Session Manager',
+                                    submission, earlier)
+                if earlier.source is not None:
+                    superseded.append(earlier[3:])
+            if digest is not None:
+                self.seen[digest] = submission
+                self.changed.add(digest)
+            kept_messages.append(msg)
+            kept_applicants.append(applicant)
+        return kept_messages, kept_applicants, superseded
+
+    def add_report(self, applicant, action, kept, superseded):
+        metrics.count('duplicates')
+        logging.info('Duplicate submission of %s %s: %s.', applicant[FIRST_NAME], applicant[LAST_NAME], action)
+        self.report.append((applicant[FIRST_NAME], applicant[LAST_NAME], applicant[E_MAIL], applicant[FRN], action,
+                            kept.received, superseded.received, superseded.export))
+
+    def commit(self):
+        # Record the identities of the submissions written since the last commit in the index.  Called when the
+        # export commits, so the index knows the messages of the rows the export journals.
+        rows = [(digest, submission.export, submission.received, *submission[3:], submission.row)
+                for digest, submission in ((digest, self.seen[digest]) for digest in self.changed)]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO identities (digest, export, received, source, uidvalidity, uid, message, row) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.changed.clear()
+
+    def write_report(self, export):
+        # Append the duplicates found since the last call to the duplicate report of export.
+        if self.report:
+            report_filename = export.append_report('_duplicates.csv', report_columns, self.report)
+            logging.warning('Found %d duplicate submissions, see %s.', len(self.report), report_filename)
+            self.report = []
+
+    def finish(self, export):
+        # The export is complete: record its identities in the index and write the duplicate report.
+        self.commit()
+        self.write_report(export)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,160 @@
+from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+import logging
+
+# emailmeform sends each registration as an html table with one row per form field.  The first cell of a row holds
+# the field label followed by '*:', e.g. 'First Name*:', and the second cell holds the value the applicant entered.
+#
+# extract_fields() reads the (label, value) pairs with a streaming HTMLParser scanner that never builds a document
+# tree.  The scanner only accepts the plain table layout emailmeform uses; anything else (nested tables, unclosed
+# cells, comments or scripts inside the table, ...) fails the layout check and the message is handed to the
+# BeautifulSoup based extract_fields_bs4(), which is the original parsing loop and the reference for the scanner.
+
+# Version of the extraction output, stored with the fields in the parse cache (see parse_cache.py).  Bump it whenever
+# a change makes extract_fields() return different pairs for the same html, so cached forms are parsed again.
+PARSER_VERSION = 1
+
+
+class LayoutError(Exception):
+    # The message does not use the simple table layout the scanner understands.
+    pass
+
+
+class TableComplete(Exception):
+    # Raised by the scanner once the first table is closed, nothing after it is needed.
+    pass
+
+
+class FormTableScanner(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.fields = []
+        self.in_table = False
+        self.in_row = False
+        self.in_cell = False
+        self.cell_text = []
+        self.name = ''
+        self.value = ''
+
+    def handle_starttag(self, tag, attrs):
+        if not self.in_table:
+            if tag == 'table':
+                self.in_table = True
+            return
+        if tag == 'tr':
+            if self.in_row:
+                raise LayoutError('nested or unclosed table row')
+            self.in_row = True
+            self.name = ''
+            self.value = ''
+        elif tag == 'td':
+            if self.in_cell or not self.in_row:
+                raise LayoutError('nested, unclosed or misplaced table cell')
+            self.in_cell = True
+            self.cell_text = []
+        elif tag in ('table', 'script', 'style'):
+            raise LayoutError(f'unexpected <{tag}> inside the form table')
+
+    def handle_endtag(self, tag):
+        if not self.in_table:
+            return
+        if tag == 'td':
+            if not self.in_cell:
+                raise LayoutError('unexpected </td>')
+            self.in_cell = False
+            text = ''.join(self.cell_text)
+            # the label cell contains '*:', every other cell is the value, the last one of each kind wins.
+            if text.find('*:') != -1:
+                self.name = text.strip().replace('*:', '')
+            else:
+                self.value = text.strip()
+        elif tag == 'tr':
+            if not self.in_row or self.in_cell:
+                raise LayoutError('unexpected </tr>')
+            self.in_row = False
+            self.fields.append((self.name, self.value))
+        elif tag == 'table':
+            if self.in_row:
+                raise LayoutError('table closed inside a row')
+            raise TableComplete()
+
+    def handle_data(self, data):
+        if self.in_cell:
+            self.cell_text.append(data)
+
+    def handle_comment(self, data):
+        if self.in_table:
+            raise LayoutError('comment inside the form table')
+
+    def handle_decl(self, decl):
+        if self.in_table:
+            raise LayoutError('declaration inside the form table')
+
+    def handle_pi(self, data):
+        if self.in_table:
+            raise LayoutError('processing instruction inside the form table')
+
+    def unknown_decl(self, data):
+        if self.in_table:
+            raise LayoutError('CDATA inside the form table')
+
+
+def table_start(html):
+    # Index of the form table, so the scanner can skip the document head.  Only used when no comment or script comes
+    # before the table, because either could hide a '<table' that is not a real tag.
+    lowered = html.lower()
+    start = lowered.find('<table')
+    if start == -1:
+        return 0
+    if lowered.find('<!--', 0, start) != -1 or lowered.find('<script', 0, start) != -1:
+        return 0
+    return start
+
+
+def scan_fields(html):
+    # Run the streaming scanner over html and return the (label, value) pairs of every table row.
+    scanner = FormTableScanner()
+    try:
+        scanner.feed(html[table_start(html):])
+        scanner.close()
+    except TableComplete:
+        return scanner.fields
+    raise LayoutError('form table not found or not closed')
+
+
+def extract_fields_bs4(html):
+    # Reference implementation using BeautifulSoup, used for messages the scanner does not accept.
+    fields = []
+    # emailme form data resides in a html table.
+    table = BeautifulSoup(html, 'html.parser').find('table')
+    if table is None:
+        # not a registration form, it has no fields and is quarantined
+        return fields
+    # get all table rows
+    table_rows = table.findAll('tr')
+    # process each row to get the table data.
+    for row in table_rows:
+        name = ""
+        value = ""
+        # field name will contain '*:' and the will need to be stripped out.
+        # the first td item should be the field name with *:, ex first name*:
+        # the second td item should be the value
+        for item in row.findAll('td'):
+            if item.text.find("*:") != -1:
+                name = item.text.strip().replace("*:", "")
+            else:
+                value = item.text.strip()
+        fields.append((name, value))
+    return fields
+
+
+def extract_fields(html):
+    # Return the (label, value) pairs of an emailmeform registration, in form order.  A message without html or
+    # without a table has no pairs, its empty layout lacks the labels of cfg.Header.required.
+    if not html:
+        return []
+    try:
+        return scan_fields(html)
+    except LayoutError as e:
+        logging.info('Form layout check failed (%s), parsing with BeautifulSoup.', e)
+        return extract_fields_bs4(html)
@@ -0,0 +1,351 @@
+from collections import namedtuple
+from email import message_from_bytes
+from imap_tools import AND, MailBox, MailBoxUnencrypted, MailMessageFlags
+from imap_tools.errors import MailboxFetchError, MailboxSearchError
+from imap_tools.message import MailMessage
+from imap_tools.utils import check_command_status, chunks
+import base64
+import config as cfg
+import datetime
+import imaplib
+import logging
+import metrics
+import quopri
+import re
+import select
+import ssl
+import time
+
+# Fetch result.  Holds the UID of a registration form, the decoded text/html part, which is all the parser needs
+# from a message, the time the message was received as a local datetime and its Message-ID (None if unknown).
+# Messages found in the parse cache carry the cached (label, value) pairs as fields and may have no html.
+HtmlMessage = namedtuple('HtmlMessage', 'uid html received message_id fields', defaults=(None, None, None))
+
+FORM_SENDER = 'burst@emailmeform.com'  # emailmeform sends every registration form from this address
+token_pattern = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+literal_pattern = re.compile(rb'\{(\d+)\}$')
+uid_pattern = re.compile(rb'UID (\d+)')
+new_mail_pattern = re.compile(rb'\* \d+ (EXISTS|RECENT)')
+
+
+def connect_mailbox(server, user, password, folder='INBOX', port=993, ssl=True):
+    # Log into an IMAP server and select folder, None leaves the folder unselected.
+    with metrics.timed('imap_login'):
+        mailbox = MailBox(server, port) if ssl else MailBoxUnencrypted(server, port)
+        return mailbox.login(user, password, initial_folder=folder)
+
+
+def registration_search_criteria(since=None, **criteria):
+    # Build the server side search for registration forms from FORM_SENDER, narrowed down by the optional date window
+    # and subject from cfg.Search and any extra criteria passed in.  since narrows the window further.
+    if cfg.Search.since is not None or since is not None:
+        criteria['date_gte'] = max(date for date in (cfg.Search.since, since) if date is not None)
+    if cfg.Search.before is not None:
+        criteria['date_lt'] = cfg.Search.before
+    if cfg.Search.subject is not None:
+        criteria['subject'] = cfg.Search.subject
+    return AND(from_=FORM_SENDER, **criteria)
+
+
+def search_uids(mb, criteria):
+    # Search the current folder and return the UIDs of matching messages.  Only the UIDs are held in memory, the
+    # message bodies are fetched later in batches.
+    with metrics.timed('imap_search'):
+        search_result = mb.box.uid('SEARCH', None, str(criteria))
+    check_command_status(search_result, MailboxSearchError)
+    return search_result[1][0].decode().split() if search_result[1][0] else []
+
+
+def has_unread_data(box):
+    # True if the connection holds received data that select() on its socket does not see: lines imaplib has
+    # already read into its buffered reader, e.g. an untagged EXISTS that came in the same packet as the IDLE
+    # continuation, and data an SSL socket has decrypted but not handed out yet.  The buffer is peeked at with the
+    # socket made non-blocking, so an empty buffer does not wait for the server.
+    pending = getattr(box.sock, 'pending', None)
+    if pending and pending():
+        return True
+    timeout = box.sock.gettimeout()
+    box.sock.settimeout(0.0)
+    try:
+        return bool(box.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        box.sock.settimeout(timeout)
+
+
+def wait_for_mail(mb, timeout):
+    # Wait in IMAP IDLE (RFC 2177) until the server reports new messages in the selected folder or timeout seconds
+    # have passed, and return True if it did.  imap_tools has no IDLE support, so the command is run on the imaplib
+    # connection directly.  Servers without IDLE are simply given timeout seconds.
+    box = mb.box
+    if 'IDLE' not in box.capabilities:
+        time.sleep(timeout)
+        return True
+    tag = b'IDLE1'
+    box.send(tag + b' IDLE\r\n')
+    line = box.readline()
+    if not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f'IDLE failed: {line.decode(errors="replace").strip()}')
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not has_unread_data(box) and not select.select([box.sock], [], [], remaining)[0]:
+            break
+        line = box.readline()
+        if not line:
+            raise imaplib.IMAP4.abort('connection closed during IDLE')
+        changed = new_mail_pattern.match(line) is not None
+    box.send(b'DONE\r\n')
+    while True:
+        line = box.readline()
+        if not line:
+            raise imaplib.IMAP4.abort('connection closed during IDLE')
+        if line.startswith(tag + b' '):
+            if not line.startswith(tag + b' OK'):
+                raise imaplib.IMAP4.error(f'IDLE failed: {line.decode(errors="replace").strip()}')
+            return changed
+        changed = changed or new_mail_pattern.match(line) is not None
+
+
+def fetch_message_batches(mb, uids, batch_size, mark_seen=True, cached=None):
+    # Generator that fetches the complete messages for the given UIDs, batch_size messages per FETCH command, and
+    # yields one list of HtmlMessage objects per batch.  Only a single batch is held in memory at a time.
+    # cached is the parse_cache.MailboxCache of the folder, messages it knows by uid are not fetched at all.
+    message_parts = "(BODY{}[] UID FLAGS RFC822.SIZE INTERNALDATE)".format('' if mark_seen else '.PEEK')
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        known = cached.by_uid(batch) if cached is not None else {}
+        messages = {uid: HtmlMessage(uid, None, received, None, fields) for uid, (fields, received) in known.items()}
+        fetch_uids = [uid for uid in batch if uid not in known]
+        if fetch_uids:
+            logging.info('Fetching messages %d to %d of %d.', start + 1, start + len(batch), len(uids))
+            fetch_result = timed_fetch(mb, fetch_uids, message_parts)
+            metrics.count('messages_fetched', len(fetch_uids))
+            for fetch_item in chunks(fetch_result[1], 2):
+                msg = MailMessage(fetch_item)
+                if msg.uid:
+                    message_id = msg.headers.get('message-id', ('',))[0].strip() or None
+                    messages[msg.uid] = HtmlMessage(msg.uid, msg.html, parse_internaldate(fetch_item), message_id)
+        if cached is not None:
+            fetched = {uid: msg.html for uid, msg in messages.items() if msg.fields is None}
+            received = {uid: msg.received for uid, msg in messages.items()}
+            for uid, fields in cached.by_html(fetched, received).items():
+                messages[uid] = messages[uid]._replace(fields=fields)
+            if mark_seen and known:
+                mb.flag(list(known), MailMessageFlags.SEEN, True)
+        yield [messages[uid] for uid in batch if uid in messages]
+
+
+def fetch_html_batches(mb, uids, batch_size, mark_seen=True, cached=None):
+    # Lean version of fetch_message_batches().  The BODYSTRUCTURE of each message in the batch is fetched first, then
+    # only the text/html part is downloaded with BODY.PEEK[section].  Headers, the plain text alternative and any
+    # attachments never leave the server.  Yields one list of HtmlMessage objects per batch, in UID order.
+    # The Message-ID is fetched with the BODYSTRUCTURE, the duplicate index (see dedup.py) uses it to recognize forms
+    # that are read again.  With cached, the parse_cache.MailboxCache of the folder, messages known by uid are not
+    # fetched at all and messages known by Message-ID skip the html download.
+    metadata = '(UID INTERNALDATE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        known = cached.by_uid(batch) if cached is not None else {}
+        cached_fields = {uid: fields for uid, (fields, _) in known.items()}
+        received = {uid: date for uid, (_, date) in known.items()}
+        message_ids = {}
+        html_parts = {}
+        fetch_uids = [uid for uid in batch if uid not in known]
+        if fetch_uids:
+            logging.info('Fetching html parts of messages %d to %d of %d.', start + 1, start + len(batch), len(uids))
+            fetch_result = timed_fetch(mb, fetch_uids, metadata)
+            responses = split_fetch_responses(fetch_result[1])
+        else:
+            responses = []
+
+        bodystructures = {}
+        for response in responses:
+            uid, bodystructure, message_id = parse_bodystructure_response(response)
+            received[uid] = parse_internaldate(response)
+            message_ids[uid] = message_id
+            bodystructures[uid] = bodystructure
+        if cached is not None and message_ids:
+            cached_fields.update(cached.by_message_id(message_ids, received))
+
+        # group the messages by the section holding their html, so each group costs a single FETCH command.
+        sections = {}
+        encodings = {}
+        for uid, bodystructure in bodystructures.items():
+            if uid in cached_fields:
+                continue
+            html_part = find_html_part(bodystructure)
+            if html_part is None:
+                logging.warning('Message UID %s has no text/html part, fetching the complete message.', uid)
+                for msg in fetch_message_batches(mb, [uid], 1, mark_seen=False):
+                    html_parts.update((m.uid, m.html) for m in msg)
+                continue
+            section, encoding, charset = html_part
+            sections.setdefault(section, []).append(uid)
+            encodings[uid] = (encoding, charset)
+
+        for section, section_uids in sections.items():
+            fetch_result = timed_fetch(mb, section_uids, f'(UID BODY.PEEK[{section}])')
+            metrics.count('messages_fetched', len(section_uids))
+            for uid, data in split_literal_responses(fetch_result[1]):
+                html_parts[uid] = decode_part(data, *encodings[uid])
+        if cached is not None and html_parts:
+            cached_fields.update(cached.by_html(html_parts, received))
+
+        if mark_seen:
+            mb.flag(batch, MailMessageFlags.SEEN, True)
+        yield [HtmlMessage(uid, html_parts.get(uid), received.get(uid), message_ids.get(uid), cached_fields.get(uid))
+               for uid in batch if uid in html_parts or uid in cached_fields]
+
+
+def timed_fetch(mb, uids, message_parts):
+    # Run a UID FETCH command for uids, counting its time and the bytes the server sent in the run metrics.
+    with metrics.timed('imap_fetch'):
+        fetch_result = mb.box.uid('FETCH', ','.join(uids), message_parts)
+    check_command_status(fetch_result, MailboxFetchError)
+    metrics.count('bytes_downloaded', sum(len(item[0]) + len(item[1]) if type(item) is tuple else len(item)
+                                          for item in fetch_result[1] if item is not None))
+    return fetch_result
+
+
+def split_fetch_responses(data):
+    # imaplib returns a FETCH response as a flat list.  Plain responses are bytes, and a response containing string
+    # literals is split into (text, literal) tuples followed by the rest of the text.  Regroup the list into one list
+    # of pieces per message; a new message starts with "<sequence number> (".
+    responses = []
+    for item in data:
+        text = item[0] if type(item) is tuple else item
+        if text is None:
+            continue
+        if re.match(rb'\d+ \(', text):
+            responses.append([])
+        if responses:
+            responses[-1].append(item)
+    return responses
+
+
+def split_literal_responses(data):
+    # Return (uid, literal) pairs from a FETCH response of a single body section per message.  Most servers send the
+    # UID before the literal, some send it in the text that follows it.
+    result = []
+    for response in split_fetch_responses(data):
+        uid = None
+        literal = None
+        for item in response:
+            text = item[0] if type(item) is tuple else item
+            match = uid_pattern.search(text)
+            if match:
+                uid = match.group(1).decode()
+            if type(item) is tuple:
+                literal = item[1]
+        if uid is not None and literal is not None:
+            result.append((uid, literal))
+    return result
+
+
+def parse_internaldate(response):
+    # Receipt time from the INTERNALDATE item of a FETCH response, as a local datetime, or None.
+    for item in response:
+        text = item[0] if type(item) is tuple else item
+        if text is None:
+            continue
+        time_tuple = imaplib.Internaldate2tuple(text)
+        if time_tuple is not None:
+            return datetime.datetime.fromtimestamp(time.mktime(time_tuple))
+    return None
+
+
+def tokenize(response):
+    # Split the pieces of one FETCH response into tokens.  String literals are passed through as bytes tokens.
+    tokens = []
+    for item in response:
+        text = item[0] if type(item) is tuple else item
+        match = literal_pattern.search(text)
+        if match:
+            text = text[:match.start()]
+        tokens.extend(token_pattern.findall(text))
+        if type(item) is tuple:
+            tokens.append(('literal', item[1]))
+    return tokens
+
+
+def parse_tokens(tokens):
+    # Build nested lists from the tokens of a parenthesized IMAP expression.  NIL becomes None, quoted strings and
+    # literals become str, everything else is kept as an atom string.
+    stack = [[]]
+    for token in tokens:
+        if type(token) is tuple:
+            stack[-1].append(token[1].decode(errors='replace'))
+        elif token == b'(':
+            stack.append([])
+        elif token == b')':
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        elif token.upper() == b'NIL':
+            stack[-1].append(None)
+        elif token.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode(errors='replace'))
+        else:
+            stack[-1].append(token.decode())
+    return stack[0]
+
+
+def parse_bodystructure_response(response):
+    # Return the UID, the parsed BODYSTRUCTURE and the Message-ID (None if it was not fetched) of one
+    # "<seq> (UID <uid> BODYSTRUCTURE (...) [BODY[HEADER.FIELDS (MESSAGE-ID)] {n}...])" response.
+    parsed = parse_tokens(tokenize(response))
+    items = parsed[1] if len(parsed) > 1 else []
+    values = {}
+    message_id = None
+    index = 0
+    while index + 1 < len(items):
+        name = items[index]
+        if type(name) is str and name.upper().startswith('BODY['):
+            # the field list splits the item name up: BODY[HEADER.FIELDS, (MESSAGE-ID), ], then the header literal
+            while not (type(items[index]) is str and items[index].endswith(']')):
+                index += 1
+            header = message_from_bytes((items[index + 1] or '').encode())
+            message_id = (header.get('Message-ID') or '').strip() or None
+        else:
+            values[name] = items[index + 1]
+        index += 2
+    return values.get('UID'), values.get('BODYSTRUCTURE'), message_id
+
+
+def find_html_part(bodystructure, section=''):
+    # Walk a parsed BODYSTRUCTURE and return (section, encoding, charset) of the first text/html part, or None.
+    # A multipart body starts with its sub parts; a single part body starts with its type and subtype.
+    if not bodystructure:
+        return None
+    if type(bodystructure[0]) is list:
+        for index, part in enumerate(bodystructure):
+            if type(part) is not list:
+                break
+            html_part = find_html_part(part, f'{section}.{index + 1}' if section else str(index + 1))
+            if html_part is not None:
+                return html_part
+        return None
+    if str(bodystructure[0]).lower() != 'text' or str(bodystructure[1]).lower() != 'html':
+        return None
+    params = bodystructure[2] or []
+    params = {str(k).lower(): v for k, v in zip(params[::2], params[1::2])}
+    encoding = str(bodystructure[5] or '7bit').lower()
+    # a message that is not multipart keeps its only body in section 1
+    return section or '1', encoding, params.get('charset') or 'utf-8'
+
+
+def decode_part(data, encoding, charset):
+    # Undo the content transfer encoding of a fetched body part and decode it to text.
+    if encoding == 'base64':
+        data = base64.b64decode(data)
+    elif encoding == 'quoted-printable':
+        data = quopri.decodestring(data)
+    try:
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
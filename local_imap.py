@@ -0,0 +1,518 @@
+from email import message_from_bytes
+from email.utils import parsedate_to_datetime
+from imap_fetch import parse_tokens, token_pattern
+from mail_sources import iter_archive
+import datetime
+import functools
+import re
+import socketserver
+import sys
+import threading
+
+# A tiny IMAP4rev1 server that keeps its mailbox in memory, used as a stand-in for the real mail server when testing
+# and benchmarking.  It understands just enough of the protocol for this script and imap_tools: LOGIN, SELECT/EXAMINE,
+# STATUS, LIST, CREATE, SEARCH, FETCH (BODY[], BODY.PEEK[section], BODYSTRUCTURE, header fields), STORE, COPY,
+# EXPUNGE, APPEND, NOOP, IDLE and LOGOUT, with and without UID.  There is no TLS, so point the script at it with
+# cfg.Mail.ssl = False.
+#
+# Serve an archive on localhost:  python local_imap.py mbox registrations.mbox [port]
+# or from code:
+#     with LocalImapServer() as server:
+#         server.add_message(raw_bytes)
+#         MailBoxUnencrypted('127.0.0.1', server.port).login('user', 'password')
+
+month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+literal_pattern = re.compile(rb'\{(\d+)\+?\}$')
+embedded_literal_pattern = re.compile(rb'\{(\d+)\}')
+
+
+class LocalFolder:
+    def __init__(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []  # list of [uid, raw bytes, set of flags]
+
+    def add(self, raw, flags=()):
+        self.messages.append([self.uidnext, raw, set(flags)])
+        self.uidnext += 1
+        return self.uidnext - 1
+
+
+class LocalImapServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), user='user', password='password', uidvalidity=1):
+        super().__init__(address, LocalImapHandler)
+        self.user = user
+        self.password = password
+        self.uidvalidity = uidvalidity
+        self.folders = {'INBOX': LocalFolder(uidvalidity)}
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.bytes_sent = 0  # total bytes of all responses, for benchmarks
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def load_archive(self, kind, path, folder='INBOX'):
+        # Deliver every message of an mbox, maildir or eml archive, returns the number of messages.
+        count = 0
+        for raw in iter_archive(kind, path):
+            self.add_message(raw, folder)
+            count += 1
+        return count
+
+    def add_message(self, raw, folder='INBOX', flags=()):
+        # Deliver a message to a folder, waking up any client sitting in IDLE.
+        with self.lock:
+            uid = self.folders.setdefault(folder, LocalFolder(self.uidvalidity)).add(raw, flags)
+            self.changed.notify_all()
+        return uid
+
+    def start(self):
+        # Serve from a background thread, returns the server so it can be used as MailBox('127.0.0.1', port).
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+
+class LocalImapHandler(socketserver.StreamRequestHandler):
+    # responses are written line by line, don't let Nagle's algorithm hold them back
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.folder = None
+        self.readonly = False
+        self.send(b'* OK [CAPABILITY IMAP4rev1 IDLE UIDPLUS] local IMAP stand-in ready')
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            tag, _, rest = line.partition(b' ')
+            command, _, args = rest.partition(b' ')
+            command = command.upper()
+            uid = command == b'UID'
+            if uid:
+                command, _, args = args.partition(b' ')
+                command = command.upper()
+            method = getattr(self, 'do_' + command.decode(errors='replace'), None)
+            if method is None:
+                self.send(tag + b' BAD unknown command')
+                continue
+            try:
+                with self.server.lock:
+                    result = method(tag, args, uid) if command in (b'SEARCH', b'FETCH', b'STORE', b'COPY') \
+                        else method(tag, args)
+            except Exception as e:  # noqa report protocol errors to the client instead of dropping the connection
+                self.send(tag + b' BAD ' + str(e).encode())
+                continue
+            if result == 'logout':
+                return
+
+    def send(self, line):
+        self.write(line + b'\r\n')
+
+    def write(self, data):
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+
+    def read_command(self):
+        # Read one command line.  Any {n} literal it carries is read as well and embedded as {n}<n bytes>.
+        line = self.rfile.readline()
+        if not line:
+            return None
+        line = line.rstrip(b'\r\n')
+        rest = line
+        while True:
+            match = literal_pattern.search(rest)
+            if not match:
+                return line
+            if not match.group(0).endswith(b'+}'):
+                self.send(b'+ Ready for literal data')
+            literal = self.rfile.read(int(match.group(1)))
+            rest = self.rfile.readline().rstrip(b'\r\n')
+            line = line[:len(line) - len(match.group(0))] + f'{{{len(literal)}}}'.encode() + literal + rest
+
+    def arguments(self, args):
+        # Parse the argument string of a command into atoms, strings and nested lists.
+        tokens = []
+        position = 0
+        while position < len(args):
+            match = embedded_literal_pattern.match(args, position)
+            if match:
+                end = match.end() + int(match.group(1))
+                tokens.append(('literal', args[match.end():end]))
+                position = end
+                continue
+            match = token_pattern.match(args, position)
+            if match:
+                tokens.append(match.group(0))
+                position = match.end()
+            else:
+                position += 1
+        return parse_tokens(tokens)
+
+    def selected(self):
+        if self.folder is None:
+            raise ValueError('no folder selected')
+        return self.server.folders[self.folder]
+
+    def do_CAPABILITY(self, tag, args):
+        self.send(b'* CAPABILITY IMAP4rev1 IDLE UIDPLUS')
+        self.send(tag + b' OK CAPABILITY completed')
+
+    def do_NOOP(self, tag, args):
+        if self.folder is not None:
+            self.send(f'* {len(self.selected().messages)} EXISTS'.encode())
+        self.send(tag + b' OK NOOP completed')
+
+    def do_LOGIN(self, tag, args):
+        user, password = self.arguments(args)[:2]
+        if (user, password) != (self.server.user, self.server.password):
+            self.send(tag + b' NO [AUTHENTICATIONFAILED] invalid credentials')
+        else:
+            self.send(tag + b' OK LOGIN completed')
+
+    def do_LOGOUT(self, tag, args):
+        self.send(b'* BYE logging out')
+        self.send(tag + b' OK LOGOUT completed')
+        return 'logout'
+
+    def do_SELECT(self, tag, args, readonly=False):
+        name = self.arguments(args)[0]
+        if name not in self.server.folders:
+            self.send(tag + b' NO no such folder')
+            return
+        self.folder = name
+        self.readonly = readonly
+        folder = self.selected()
+        self.send(b'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.send(f'* {len(folder.messages)} EXISTS'.encode())
+        self.send(b'* 0 RECENT')
+        self.send(f'* OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid'.encode())
+        self.send(f'* OK [UIDNEXT {folder.uidnext}] predicted next UID'.encode())
+        self.send(tag + (b' OK [READ-ONLY] EXAMINE completed' if readonly else b' OK [READ-WRITE] SELECT completed'))
+
+    def do_EXAMINE(self, tag, args):
+        self.do_SELECT(tag, args, readonly=True)
+
+    def do_STATUS(self, tag, args):
+        name, items = self.arguments(args)[:2]
+        folder = self.server.folders.get(name)
+        if folder is None:
+            self.send(tag + b' NO no such folder')
+            return
+        values = {
+            'MESSAGES': len(folder.messages),
+            'RECENT': 0,
+            'UIDNEXT': folder.uidnext,
+            'UIDVALIDITY': folder.uidvalidity,
+            'UNSEEN': sum(1 for m in folder.messages if '\\Seen' not in m[2]),
+        }
+        status = ' '.join(f'{item.upper()} {values[item.upper()]}' for item in items if item.upper() in values)
+        self.send(f'* STATUS "{name}" ({status})'.encode())
+        self.send(tag + b' OK STATUS completed')
+
+    def do_LIST(self, tag, args):
+        for name in self.server.folders:
+            self.send(f'* LIST () "/" "{name}"'.encode())
+        self.send(tag + b' OK LIST completed')
+
+    def do_CREATE(self, tag, args):
+        name = self.arguments(args)[0]
+        self.server.folders.setdefault(name, LocalFolder(self.server.uidvalidity))
+        self.send(tag + b' OK CREATE completed')
+
+    def do_APPEND(self, tag, args):
+        arguments = self.arguments(args)
+        flags = next((a for a in arguments[1:] if type(a) is list), [])
+        raw = arguments[-1].encode('utf-8', 'surrogateescape')
+        uid = self.server.add_message(raw, arguments[0], flags)
+        self.send(tag + f' OK [APPENDUID {self.server.folders[arguments[0]].uidvalidity} {uid}] APPEND completed'
+                  .encode())
+
+    def do_EXPUNGE(self, tag, args):
+        folder = self.selected()
+        for seq in range(len(folder.messages), 0, -1):
+            if '\\Deleted' in folder.messages[seq - 1][2]:
+                del folder.messages[seq - 1]
+                self.send(f'* {seq} EXPUNGE'.encode())
+        self.send(tag + b' OK EXPUNGE completed')
+
+    def do_IDLE(self, tag, args):
+        # Report new messages with EXISTS until the client sends DONE.  A helper thread watches for DONE so the
+        # handler can wait on the server's condition variable.
+        folder = self.selected()
+        self.send(b'+ idling')
+        done = threading.Event()
+
+        def wait_for_done():
+            self.rfile.readline()
+            done.set()
+            with self.server.lock:
+                self.server.changed.notify_all()
+
+        threading.Thread(target=wait_for_done, daemon=True).start()
+        known = len(folder.messages)
+        while not done.is_set():
+            self.server.changed.wait(1)
+            if len(folder.messages) != known:
+                known = len(folder.messages)
+                self.send(f'* {known} EXISTS'.encode())
+                self.wfile.flush()
+        self.send(tag + b' OK IDLE terminated')
+
+    def resolve(self, message_set, uid):
+        # Return (seq, message) pairs for an IMAP sequence or UID set such as "1,3:5,7:*".
+        messages = self.selected().messages
+        if not messages:
+            return []
+        keys = [m[0] for m in messages] if uid else list(range(1, len(messages) + 1))
+        wanted = set()
+        for part in str(message_set).split(','):
+            low, _, high = part.partition(':')
+            low = keys[-1] if low == '*' else int(low)
+            high = low if not high else keys[-1] if high == '*' else int(high)
+            wanted.add((min(low, high), max(low, high)))
+        return [(seq + 1, m) for seq, (key, m) in enumerate(zip(keys, messages))
+                if any(low <= key <= high for low, high in wanted)]
+
+    def do_SEARCH(self, tag, args, uid):
+        criteria = self.arguments(args)
+        if criteria and str(criteria[0]).upper() == 'CHARSET':
+            criteria = criteria[2:]
+        messages = self.selected().messages
+        matches = []
+        for seq, message in enumerate(messages, 1):
+            if self.matches(criteria, seq, message):
+                matches.append(str(message[0] if uid else seq))
+        self.send(('* SEARCH ' + ' '.join(matches)).rstrip().encode())
+        self.send(tag + b' OK SEARCH completed')
+
+    def matches(self, criteria, seq, message):
+        criteria = list(criteria)
+        while criteria:
+            if not self.match_one(criteria, seq, message):
+                return False
+        return True
+
+    def match_one(self, criteria, seq, message):
+        # Consume and evaluate one search key from the front of criteria.
+        key = criteria.pop(0)
+        if type(key) is list:
+            return self.matches(key, seq, message)
+        key = key.upper()
+        uid, raw, flags = message
+        headers = parse_message(raw)
+        if key == 'ALL':
+            return True
+        if key == 'NOT':
+            return not self.match_one(criteria, seq, message)
+        if key == 'OR':
+            first = self.match_one(criteria, seq, message)
+            second = self.match_one(criteria, seq, message)
+            return first or second
+        if key in ('SEEN', 'UNSEEN'):
+            return ('\\Seen' in flags) == (key == 'SEEN')
+        if key in ('FROM', 'TO', 'SUBJECT'):
+            return criteria.pop(0).lower() in str(headers.get(key, '')).lower()
+        if key == 'HEADER':
+            name = criteria.pop(0)
+            return criteria.pop(0).lower() in str(headers.get(name, '')).lower()
+        if key == 'UID':
+            return message in [m for _, m in self.resolve(criteria.pop(0), True)]
+        if key in ('SINCE', 'BEFORE', 'ON', 'SENTSINCE', 'SENTBEFORE', 'SENTON'):
+            day, month, year = criteria.pop(0).split('-')
+            value = datetime.date(int(year), month_names.index(month.capitalize()) + 1, int(day))
+            try:
+                date = parsedate_to_datetime(headers['Date']).date()
+            except (TypeError, ValueError):
+                return False
+            if key.endswith('SINCE'):
+                return date >= value
+            if key.endswith('BEFORE'):
+                return date < value
+            return date == value
+        if re.match(r'^[\d*:,]+$', key):
+            return message in [m for _, m in self.resolve(key, False)]
+        raise ValueError(f'unsupported search key {key}')
+
+    def do_STORE(self, tag, args, uid):
+        message_set, action, flags = self.arguments(args)[:3]
+        flags = flags if type(flags) is list else [flags]
+        for seq, message in self.resolve(message_set, uid):
+            if action.upper().startswith('+'):
+                message[2].update(flags)
+            elif action.upper().startswith('-'):
+                message[2].difference_update(flags)
+            else:
+                message[2] = set(flags)
+            if not action.upper().endswith('.SILENT'):
+                flag_list = ' '.join(sorted(message[2]))
+                self.send(f'* {seq} FETCH (UID {message[0]} FLAGS ({flag_list}))'.encode())
+        self.send(tag + b' OK STORE completed')
+
+    def do_COPY(self, tag, args, uid):
+        message_set, destination = self.arguments(args)[:2]
+        if destination not in self.server.folders:
+            self.send(tag + b' NO [TRYCREATE] no such folder')
+            return
+        for seq, message in self.resolve(message_set, uid):
+            self.server.folders[destination].add(message[1], message[2] - {'\\Deleted'})
+        self.send(tag + b' OK COPY completed')
+
+    def do_FETCH(self, tag, args, uid):
+        arguments = self.arguments(args)
+        message_set, items = arguments[0], arguments[1:]
+        if len(items) == 1 and type(items[0]) is list:
+            items = items[0]
+        items = self.fetch_items(items)
+        if uid and 'UID' not in items:
+            items.insert(0, 'UID')
+        for seq, message in self.resolve(message_set, uid):
+            parts = []
+            for item in items:
+                parts.append(self.fetch_item(item, message))
+            response = b'* ' + str(seq).encode() + b' FETCH (' + b' '.join(parts) + b')'
+            self.write(response + b'\r\n')
+        self.send(tag + b' OK FETCH completed')
+
+    def fetch_items(self, items):
+        # Re-join BODY[...] items that the argument parser split at their header field lists.
+        result = []
+        for item in items:
+            if type(item) is list:
+                result[-1] += '(' + ' '.join(item) + ')'
+            elif result and result[-1].count('[') > result[-1].count(']'):
+                result[-1] += item if result[-1].endswith('(') or item.startswith(']') else ' ' + item
+            else:
+                result.append(item)
+        return result
+
+    def fetch_item(self, item, message):
+        uid, raw, flags = message
+        name = item.upper()
+        if name == 'UID':
+            return f'UID {uid}'.encode()
+        if name == 'FLAGS':
+            return f'FLAGS ({" ".join(sorted(flags))})'.encode()
+        if name == 'RFC822.SIZE':
+            return f'RFC822.SIZE {len(raw)}'.encode()
+        if name == 'INTERNALDATE':
+            return b'INTERNALDATE "' + message_internaldate(raw) + b'"'
+        if name == 'BODYSTRUCTURE':
+            return b'BODYSTRUCTURE ' + message_bodystructure(raw)
+        if name in ('RFC822', 'RFC822.PEEK'):
+            name = 'BODY[]' if name == 'RFC822' else 'BODY.PEEK[]'
+        match = re.match(r'BODY(\.PEEK)?\[(.*)\](<(\d+)\.(\d+)>)?$', item, re.IGNORECASE)
+        if not match:
+            raise ValueError(f'unsupported fetch item {item}')
+        if not match.group(1) and not self.readonly:
+            flags.add('\\Seen')
+        data = body_section(raw, match.group(2))
+        if match.group(3):
+            data = data[int(match.group(4)):int(match.group(4)) + int(match.group(5))]
+        section = match.group(2).upper()
+        return f'BODY[{section}] {{{len(data)}}}\r\n'.encode() + data
+
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def raw_payload(part):
+    payload = part.get_payload()
+    return payload.encode('utf-8', 'surrogateescape') if type(payload) is str else b''
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_message(raw):
+    # Parsed messages are cached, like a real server keeps the MIME structure of a message instead of parsing it again
+    # for every command.
+    return message_from_bytes(raw)
+
+
+@functools.lru_cache(maxsize=4096)
+def message_bodystructure(raw):
+    return bodystructure(parse_message(raw))
+
+
+@functools.lru_cache(maxsize=4096)
+def message_internaldate(raw):
+    # The stand-in has no delivery times, the Date header of the message is used as its internal date, like SEARCH
+    # SINCE/BEFORE do.
+    try:
+        date = parsedate_to_datetime(parse_message(raw)['Date'])
+    except (TypeError, ValueError):
+        date = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return f'{date.day:2d}-{month_names[date.month - 1]}-{date:%Y %H:%M:%S %z}'.encode()
+
+
+def bodystructure(part):
+    # Build the BODYSTRUCTURE of an email.message.Message part.
+    if part.is_multipart():
+        return b'(' + b''.join(bodystructure(p) for p in part.get_payload()) + \
+            f' {quote(part.get_content_subtype().upper())})'.encode()
+    params = part.get_params()[1:] if part.get_params() else []
+    params = '(' + ' '.join(f'{quote(k.upper())} {quote(v)}' for k, v in params) + ')' if params else 'NIL'
+    payload = raw_payload(part)
+    fields = [quote(part.get_content_maintype().upper()), quote(part.get_content_subtype().upper()), params,
+              quote(part.get('Content-ID')), quote(part.get('Content-Description')),
+              quote(part.get('Content-Transfer-Encoding', '7BIT').upper()), str(len(payload))]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(payload.count(b'\n')))
+    return ('(' + ' '.join(fields) + ')').encode()
+
+
+def body_section(raw, section):
+    # Return the bytes of a BODY[section] item: '', 'HEADER', 'TEXT', 'HEADER.FIELDS (A B)' or a part number.
+    header, _, text = raw.partition(b'\r\n\r\n') if b'\r\n\r\n' in raw else raw.partition(b'\n\n')
+    section = section.strip()
+    if section == '':
+        return raw
+    if section.upper() == 'HEADER':
+        return header + b'\r\n\r\n'
+    if section.upper() == 'TEXT':
+        return text
+    match = re.match(r'HEADER\.FIELDS(\.NOT)?\s*\((.*)\)', section, re.IGNORECASE)
+    if match:
+        names = {n.lower() for n in match.group(2).split()}
+        lines = []
+        for field in re.split(rb'\r?\n(?![ \t])', header):
+            name = field.split(b':', 1)[0].decode(errors='replace').lower()
+            if (name in names) != bool(match.group(1)):
+                lines.append(field)
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+    part = parse_message(raw)
+    for number in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+        elif number != '1':
+            raise ValueError(f'no body section {section}')
+    return raw_payload(part)
+
+
+if __name__ == '__main__':
+    # python local_imap.py <mbox|maildir|eml> <path> [port]
+    server = LocalImapServer(('127.0.0.1', int(sys.argv[3]) if len(sys.argv) > 3 else 1143))
+    print(f'Loaded {server.load_archive(sys.argv[1], sys.argv[2])} messages, serving IMAP on 127.0.0.1:{server.port} '
+          f'as {server.user}/{server.password}.')
+    server.serve_forever()
@@ -0,0 +1,128 @@
+from imap_fetch import FORM_SENDER, HtmlMessage
+from imap_tools.message import MailMessage
+from parse_cache import content_key
+import hashlib
+import logging
+import metrics
+import mmap
+import os
+import re
+
+# Offline input sources.  Registration forms can be read from an mbox file, a Maildir tree or a directory of .eml
+# files instead of a live IMAP login.  archive_batches() yields the forms in the same batches of HtmlMessage objects
+# the IMAP fetch functions produce, so archives go through exactly the same parsing path, but at disk speed.
+
+SOURCE_KINDS = ('imap', 'mbox', 'maildir', 'eml')
+
+# mboxrd quoting: a body line starting with 'From ' is stored as '>From ', '>From ' as '>>From ' and so on.
+from_quote_pattern = re.compile(rb'\n>(>*From )')
+
+
+def received_time(msg):
+    # Archives have no IMAP INTERNALDATE, the Date header of the message stands in for the receipt time.  Returned as
+    # a local datetime like parse_internaldate(), None if the header is missing or broken.
+    date = msg.date
+    if date.year == 1900:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date
+
+
+def iter_mbox(path):
+    # Yield the raw messages of an mbox file.  The file is memory-mapped and scanned for the '\nFrom ' lines that
+    # separate messages, so only the message being yielded is copied into memory.
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = 0 if mapped[:5] == b'From ' else mapped.find(b'\nFrom ')
+            while start != -1:
+                if mapped[start:start + 1] == b'\n':
+                    start += 1
+                end = mapped.find(b'\nFrom ', start)
+                # skip the 'From sender date' separator line itself
+                body_start = mapped.find(b'\n', start) + 1
+                message = mapped[body_start:end if end != -1 else len(mapped)]
+                yield from_quote_pattern.sub(rb'\n\1', message)
+                start = end
+
+
+def iter_maildir(path):
+    # Yield the raw messages of every cur/ and new/ directory below path, which covers a plain Maildir as well as
+    # Maildir++ sub folders.  Messages are read in file name order, which is delivery order for Maildir.
+    for directory, subdirectories, filenames in sorted(os.walk(path)):
+        subdirectories.sort()
+        if os.path.basename(directory) not in ('cur', 'new'):
+            continue
+        for filename in sorted(filenames):
+            with open(os.path.join(directory, filename), 'rb') as f:
+                yield f.read()
+
+
+def iter_eml(path):
+    # Yield the raw messages of every .eml file below path, in path order.
+    for directory, subdirectories, filenames in sorted(os.walk(path)):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith('.eml'):
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    yield f.read()
+
+
+def iter_archive(kind, path):
+    # Raw messages of an archive of the given kind.
+    readers = {'mbox': iter_mbox, 'maildir': iter_maildir, 'eml': iter_eml}
+    if kind not in readers:
+        raise ValueError(f'Unknown archive kind {kind!r}, expected one of {", ".join(readers)}.')
+    return readers[kind](path)
+
+
+def archive_uid(msg, raw):
+    # Archives have no IMAP UIDs and the position of a message changes when a file is added to a Maildir or .eml
+    # directory, so a message is identified by its Message-ID, or the hash of its html (of the whole message if it
+    # has none) when the Message-ID is missing.  The first 63 bits of the hash are the uid, an integer like an IMAP
+    # UID that the applicant store and the duplicate index key the message by.
+    message_id = msg.headers.get('message-id', ('',))[0].strip()
+    if message_id:
+        digest = hashlib.blake2b(message_id.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    elif msg.html:
+        digest = content_key(msg.html)
+    else:
+        digest = hashlib.blake2b(raw, digest_size=8).digest()
+    return str(int.from_bytes(digest[:8], 'big') >> 1)
+
+
+def with_cached_fields(batch, cached):
+    if cached is None:
+        return batch
+    found = cached.by_html({msg.uid: msg.html for msg in batch}, {})
+    return [msg._replace(fields=found[msg.uid]) if msg.uid in found else msg for msg in batch]
+
+
+def archive_batches(kind, path, batch_size, handled=(), cached=None):
+    # Generator that yields the registration forms of an archive as lists of up to batch_size HtmlMessage objects, in
+    # archive order.  Their uid is the archive_uid(); messages whose uid is in handled were written by an earlier run
+    # and are skipped.  Anything that was not sent by emailmeform is skipped too, like the IMAP search does.  With
+    # cached, a parse_cache.MailboxCache, the fields of forms read before are filled in.
+    logging.info('Reading registration forms from %s archive %s.', kind, path)
+    batch = []
+    skipped = 0
+    for raw in iter_archive(kind, path):
+        msg = MailMessage.from_bytes(raw)
+        if msg.from_.lower() != FORM_SENDER:
+            skipped += 1
+            continue
+        uid = archive_uid(msg, raw)
+        if uid in handled:
+            continue
+        message_id = msg.headers.get('message-id', ('',))[0].strip() or None
+        batch.append(HtmlMessage(uid, msg.html, received_time(msg), message_id))
+        if len(batch) == batch_size:
+            metrics.count('messages_read', len(batch))
+            yield with_cached_fields(batch, cached)
+            batch = []
+    if batch:
+        metrics.count('messages_read', len(batch))
+        yield with_cached_fields(batch, cached)
+    logging.info('Skipped %d messages that are not registration forms.', skipped)
@@ -0,0 +1,158 @@
+import config as cfg
+import contextlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+# Run metrics of the registration pipeline.  Each stage adds the wall time it spends to a timer and counts what it
+# handles, so the run summary shows whether the time went to the mail server or to the parser:
+#   imap_login, imap_search   logging into a mailbox and searching it for new forms
+#   imap_fetch                FETCH commands, including the download of the forms
+#   archive_read              reading and decoding the messages of an archive
+#   parse                     waiting for the fields of a batch.  Without parse workers this is the whole parse, with
+#                             them only the part that did not overlap the fetch of the next batch.
+#   normalize, license_check, store, dedup, csv_write
+#   commit                    flushing and fsyncing the export, the store and the parse cache
+# Counters: messages_fetched and bytes_downloaded (IMAP), messages_read (archives), cache_hits and cache_misses,
+# forms_parsed, parse_failures (forms of an unknown layout), rows_written and duplicates.
+#
+# Timers and counters are kept per process and add up over its lifetime, so in serve mode they are totals since the
+# start, the way Prometheus expects counters.  The parse workers do not report theirs, and the times of mailboxes read
+# concurrently (cfg.Mailboxes) add up to more than the wall time of the run.  The summary is logged when the run ends,
+# and cfg.Metrics can write the metrics as a Prometheus text file for the node exporter textfile collector and as
+# JSON.
+
+lock = threading.Lock()
+started = time.time()
+stage_seconds = {}
+stage_calls = {}
+counters = {}
+
+
+def count(name, amount=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def add_time(stage, seconds):
+    with lock:
+        stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+        stage_calls[stage] = stage_calls.get(stage, 0) + 1
+
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(stage, time.perf_counter() - start)
+
+
+def timed_batches(stage, batches):
+    # Iterate over batches, adding the time spent producing each batch to stage.  For generators like
+    # archive_batches() that do their work between the yields.
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        batch = next(batches, None)
+        add_time(stage, time.perf_counter() - start)
+        if batch is None:
+            return
+        yield batch
+
+
+def snapshot(status):
+    # The metrics so far as a dict, status is 'running', 'completed', 'stopped' or 'failed'.
+    with lock:
+        return {'status': status, 'started': round(started, 3), 'updated': round(time.time(), 3),
+                'seconds': round(time.time() - started, 3),
+                'stages': {stage: {'seconds': round(seconds, 6), 'calls': stage_calls[stage]}
+                           for stage, seconds in stage_seconds.items()},
+                'counters': dict(counters)}
+
+
+def log_summary(status):
+    data = snapshot(status)
+    logging.info('Run summary (%s) after %.1f seconds:', status, data['seconds'])
+    for stage, timer in sorted(data['stages'].items(), key=lambda item: -item[1]['seconds']):
+        logging.info('  %-14s %10.3f seconds in %d calls', stage, timer['seconds'], timer['calls'])
+    for name, value in sorted(data['counters'].items()):
+        logging.info('  %-18s %d', name, value)
+
+
+def prometheus_text(data):
+    # Text exposition format of the node exporter textfile collector.
+    prefix = cfg.Metrics.prefix
+    lines = [f'# HELP {prefix}_stage_seconds_total Wall time spent in each stage of the pipeline.',
+             f'# TYPE {prefix}_stage_seconds_total counter']
+    lines += [f'{prefix}_stage_seconds_total{{stage="{stage}"}} {timer["seconds"]}'
+              for stage, timer in sorted(data['stages'].items())]
+    lines += [f'# HELP {prefix}_stage_calls_total Number of times each stage of the pipeline ran.',
+              f'# TYPE {prefix}_stage_calls_total counter']
+    lines += [f'{prefix}_stage_calls_total{{stage="{stage}"}} {timer["calls"]}'
+              for stage, timer in sorted(data['stages'].items())]
+    for name, value in sorted(data['counters'].items()):
+        lines += [f'# TYPE {prefix}_{name}_total counter', f'{prefix}_{name}_total {value}']
+    lines += [f'# HELP {prefix}_run_failed 1 if the last run failed.', f'# TYPE {prefix}_run_failed gauge',
+              f'{prefix}_run_failed {int(data["status"] == "failed")}',
+              f'# TYPE {prefix}_run_start_timestamp_seconds gauge',
+              f'{prefix}_run_start_timestamp_seconds {data["started"]}',
+              f'# TYPE {prefix}_last_update_timestamp_seconds gauge',
+              f'{prefix}_last_update_timestamp_seconds {data["updated"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def replace_file(filename, text):
+    # The file is replaced in one step, so the node exporter never reads half of it.
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write(text)
+    os.replace(tmp_filename, filename)
+
+
+def write_files(status):
+    # Write the metrics to the files of cfg.Metrics.
+    if not cfg.Metrics.textfile and not cfg.Metrics.json_file:
+        return
+    data = snapshot(status)
+    if cfg.Metrics.textfile:
+        replace_file(cfg.Metrics.textfile, prometheus_text(data))
+    if cfg.Metrics.json_file:
+        replace_file(cfg.Metrics.json_file, json.dumps(data, indent=2))
+
+
+@contextlib.contextmanager
+def profiling(profile_file=None, trace_memory=0):
+    # Run the block under cProfile and/or tracemalloc.  The profile is saved to profile_file for pstats or snakeviz
+    # and its top functions are logged; with trace_memory the top trace_memory allocation sites are logged.  The
+    # profilers are imported only when asked for, pstats alone takes longer to load than a dry run.
+    profiler = None
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start(25)
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            import pstats
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(25)
+            logging.info('Profile saved to %s, top functions:\n%s', profile_file, report.getvalue())
+        if trace_memory:
+            allocations = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            logging.info('Traced memory: %.1f MiB at the end, %.1f MiB peak.  Top allocators:', current / 2 ** 20,
+                         peak / 2 ** 20)
+            for stat in allocations.statistics('lineno')[:trace_memory]:
+                logging.info('  %s', stat)
@@ -0,0 +1,176 @@
+from applicant import label_position
+from collections import namedtuple
+import logging
+
+# Clean up rules for the values of a registration form.  cfg.Header.rules names the rule of each form label, the rule
+# functions below turn the value the applicant entered into the values of the label's column and of any other column
+# the rule sets, e.g. the Callsign rule also decides UPGRADE_LICENSE.  compile_rules() turns the table into one
+# CompiledRule per label, once at startup, so normalizing a form is a dict lookup and a call per field no matter how
+# many rules there are:
+#   row(applicant, value)    stores the results for one applicant.
+#   column(columns, values)  stores the results for the values of the label of a whole batch of applicants, where
+#                            columns is the batch as a list of column lists.  Each distinct value is cleaned up once.
+#
+# emailmeform has changed the labels of the form over the years, so a mailbox can hold forms of several layouts.  The
+# fingerprint of a form's layout is its sequence of labels.  LayoutPlans resolves the labels of each new layout to
+# their compiled rules once and keeps the resulting plan, every later form of the same layout is normalized without
+# looking up a single label.  Layouts with labels that are not in cfg.Header.fields (or cfg.Header.aliases), or
+# without the labels of cfg.Header.required, have no plan and their forms are quarantined instead.
+
+CompiledRule = namedtuple('CompiledRule', 'row column')
+
+# name: (function, labels of the other columns it sets).  A rule function returns the value of the label's own
+# column, followed by the values of the other columns in the listed order.
+rule_functions = {}
+
+
+def rule(name, *other_labels):
+    def register(function):
+        rule_functions[name] = (function, other_labels)
+        return function
+    return register
+
+
+@rule('none_to_empty')
+def none_to_empty(value):
+    # NONE means the applicant has no middle initial or suffix.
+    return '' if value.upper() == 'NONE' else value
+
+
+@rule('capitalize')
+def capitalize(value):
+    # Capitalize first letter only.
+    return value.lower().capitalize()
+
+
+@rule('upper')
+def upper(value):
+    return value.upper()
+
+
+@rule('po_box', 'PO Box')
+def po_box(value):
+    # A PO Box goes into PO_BOX and leaves the street address empty.
+    if value.find('PO') == -1:
+        return value, ''
+    return '', value
+
+
+@rule('callsign', 'UPGRADE_LICENSE')
+def callsign(value):
+    # NOCALL means a new license.  A callsign is upper cased and marks an upgrade, anything else is flagged as ERROR
+    # and needs checked.
+    if value.upper() == 'NOCALL':
+        return '', False
+    if value.isalnum():
+        return value.upper(), True
+    return 'ERROR', False
+
+
+@rule('exams', 'REQUESTED_ELEMENT_3', 'REQUESTED_ELEMENT_4')
+def exams(value):
+    # The exams the applicant is interested in are kept in the Notes column.  If element 3 and/or element 4 are
+    # selected, these selections should show up on the Applicant's registration form in Session Manager.
+    selected = value.split(', ')
+    element_3 = element_4 = ''
+    for exam in selected:
+        match exam:
+            case 'Element 2 (Technician)':
+                if len(selected) == 1:
+                    element_3 = False
+                    element_4 = False
+            case 'Element 3 (General)':
+                element_3 = True
+                element_4 = False
+            case 'Element 4 (Amateur Extra)':
+                if len(selected) == 1:
+                    element_3 = False
+                element_4 = True
+    return value, element_3, element_4
+
+
+def copy_rule(position):
+    # Labels without a rule keep the value as it is.
+    def row(applicant, value):
+        applicant[position] = value
+
+    def column(columns, values):
+        columns[position] = list(values)
+    return CompiledRule(row, column)
+
+
+def single_column_rule(function, position):
+    def row(applicant, value):
+        applicant[position] = function(value)
+
+    def column(columns, values):
+        results = {value: function(value) for value in set(values)}
+        columns[position] = [results[value] for value in values]
+    return CompiledRule(row, column)
+
+
+def multi_column_rule(function, positions):
+    def row(applicant, value):
+        for position, result in zip(positions, function(value)):
+            applicant[position] = result
+
+    def column(columns, values):
+        results = {value: function(value) for value in set(values)}
+        rows = [results[value] for value in values]
+        for index, position in enumerate(positions):
+            columns[position] = [result[index] for result in rows]
+    return CompiledRule(row, column)
+
+
+def ignore(*args):
+    pass
+
+
+# Labels that are read but not written, see cfg.Header.ignored.
+ignore_rule = CompiledRule(ignore, ignore)
+
+
+def compile_rules(rules):
+    # Build the per-label dispatch table for a {label: rule name} table like cfg.Header.rules.  Every label of
+    # cfg.Header.fields gets an entry, labels without a rule are copied.
+    unknown = set(rules.values()) - set(rule_functions)
+    if unknown:
+        raise ValueError(f'Unknown normalization rules {", ".join(sorted(unknown))}, expected one of '
+                         f'{", ".join(rule_functions)}.')
+    compiled = {label: copy_rule(position) for label, position in label_position.items()}
+    for label, name in rules.items():
+        function, other_labels = rule_functions[name]
+        if other_labels:
+            positions = (label_position[label],) + tuple(label_position[other] for other in other_labels)
+            compiled[label] = multi_column_rule(function, positions)
+        else:
+            compiled[label] = single_column_rule(function, label_position[label])
+    return compiled
+
+
+class LayoutPlans:
+    def __init__(self, rules, aliases, required, ignored=()):
+        self.normalizers = compile_rules(rules)
+        self.normalizers.update((label, ignore_rule) for label in ignored)
+        self.aliases = aliases
+        self.required = frozenset(required)
+        self.plans = {}
+
+    def plan(self, labels):
+        # The compiled rule of every label of a layout, in label order, or None for an unknown layout.
+        try:
+            return self.plans[labels]
+        except KeyError:
+            plan = self.plans[labels] = self.compile(labels)
+            return plan
+
+    def compile(self, labels):
+        resolved = [self.aliases.get(label, label) for label in labels]
+        unknown = [label for label, name in zip(labels, resolved) if name not in self.normalizers]
+        missing = self.required.difference(resolved)
+        if unknown or missing:
+            logging.warning('Unknown form layout %d: unknown labels %s, missing labels %s.', len(self.plans) + 1,
+                            unknown or 'none', sorted(missing) or 'none')
+            return None
+        logging.info('New form layout %d with %d labels.', len(self.plans) + 1, len(labels))
+        return tuple(self.normalizers[name] for name in resolved)
@@ -0,0 +1,186 @@
+from form_extractor import PARSER_VERSION
+import datetime
+import hashlib
+import json
+import logging
+import metrics
+import sqlite3
+import threading
+import time
+
+# On-disk cache of the (label, value) pairs extracted from registration forms.  Forms that are processed again, after
+# a normalization rule changed, a checkpoint was reset or the mailbox got a new UIDVALIDITY, are neither downloaded
+# nor parsed a second time.
+#
+# Extracted fields are stored under a hash of the form's html, tagged with form_extractor.PARSER_VERSION; entries of
+# other parser versions are thrown away.  Two kinds of references point at them:
+#   uid:<mailbox>/<uidvalidity>/<uid>  a message in a mailbox folder, which IMAP guarantees never changes.  A hit
+#                                      skips the whole fetch of the message.
+#   mid:<Message-ID>                   the message wherever it is stored.  The Message-ID is fetched together with the
+#                                      BODYSTRUCTURE, a hit skips the download of the html part.
+# Messages that are neither found by uid nor by Message-ID are downloaded and looked up by the hash of their html,
+# which still saves the parse.  The cache is limited to cfg.Cache.max_bytes of fields, least recently used forms are
+# evicted first.
+
+# Fraction of max_bytes the cache is shrunk to when it outgrows the limit, so eviction does not run on every commit.
+evict_to = 0.9
+
+
+def content_key(html):
+    return hashlib.blake2b(html.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def location_ref(source, uidvalidity, uid):
+    return f'uid:{source}/{uidvalidity}/{uid}'
+
+
+def message_id_ref(message_id):
+    return 'mid:' + message_id
+
+
+class ParseCache:
+    def __init__(self, cache_file, max_bytes):
+        # Lookups run in the IMAP threads of the asyncio ingestion, so the connection is shared behind a lock.
+        self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS forms (key BLOB PRIMARY KEY, parser INTEGER, '
+                                    'fields TEXT, size INTEGER, used REAL) WITHOUT ROWID')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS forms_used ON forms (used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS refs (ref TEXT PRIMARY KEY, key BLOB, '
+                                    'received TEXT) WITHOUT ROWID')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS refs_key ON refs (key)')
+            stale = self.connection.execute('DELETE FROM forms WHERE parser != ?', (PARSER_VERSION,)).rowcount
+            if stale:
+                logging.info('Dropped %d cached forms of an older parser version.', stale)
+                self.connection.execute('DELETE FROM refs WHERE key NOT IN (SELECT key FROM forms)')
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM forms').fetchone()[0]
+
+    def mailbox(self, source, uidvalidity):
+        # Lookups for the messages of one source, see MailboxCache.
+        return MailboxCache(self, source, uidvalidity)
+
+    def lookup(self, refs):
+        # {ref: (key, fields, received)} of the given references that are cached.  Hits count as a use of the form.
+        found = {}
+        refs = list(refs)
+        with self.lock:
+            for start in range(0, len(refs), 500):
+                chunk = refs[start:start + 500]
+                for ref, key, fields, received in self.connection.execute(
+                        f'SELECT refs.ref, forms.key, forms.fields, refs.received FROM refs '
+                        f'JOIN forms ON forms.key = refs.key WHERE refs.ref IN ({", ".join("?" * len(chunk))})',
+                        chunk):
+                    found[ref] = (key, json.loads(fields), received)
+            self.touch(value[0] for value in found.values())
+        return found
+
+    def lookup_keys(self, keys):
+        # {key: fields} of the given content keys that are cached.
+        found = {}
+        keys = list(keys)
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                for key, fields in self.connection.execute(
+                        f'SELECT key, fields FROM forms WHERE key IN ({", ".join("?" * len(chunk))})', chunk):
+                    found[key] = json.loads(fields)
+            self.touch(found)
+        return found
+
+    def touch(self, keys):
+        self.connection.executemany('UPDATE forms SET used = ? WHERE key = ?', ((time.time(), key) for key in keys))
+
+    def add_refs(self, refs):
+        # Point (ref, key, received) references at cached forms.
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO refs (ref, key, received) VALUES (?, ?, ?)', refs)
+
+    def add(self, checkpoint, msg, fields):
+        # Cache the fields just extracted from msg, a message of the source of checkpoint.
+        key = content_key(msg.html)
+        data = json.dumps(fields, separators=(',', ':'))
+        refs = [(message_id_ref(msg.message_id), key, None)] if msg.message_id else []
+        if checkpoint['uidvalidity'] is not None:
+            received = msg.received.isoformat(sep=' ', timespec='seconds') if msg.received else None
+            refs.append((location_ref(checkpoint['key'], checkpoint['uidvalidity'], msg.uid), key, received))
+        with self.lock:
+            replaced = self.connection.execute('SELECT size FROM forms WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO forms (key, parser, fields, size, used) '
+                                    'VALUES (?, ?, ?, ?, ?)', (key, PARSER_VERSION, data, len(data), time.time()))
+            self.connection.executemany('INSERT OR REPLACE INTO refs (ref, key, received) VALUES (?, ?, ?)', refs)
+            self.size += len(data) - (replaced[0] if replaced else 0)
+
+    def commit(self):
+        with self.lock:
+            if self.size > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # Drop the least recently used forms until the cache is back under evict_to x max_bytes.
+        target = self.size - self.max_bytes * evict_to
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM forms ORDER BY used'):
+            evicted.append((key,))
+            target -= size
+            self.size -= size
+            if target <= 0:
+                break
+        self.connection.executemany('DELETE FROM forms WHERE key = ?', evicted)
+        self.connection.executemany('DELETE FROM refs WHERE key = ?', evicted)
+        logging.info('Evicted %d forms from the parse cache.', len(evicted))
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+        logging.info('Parse cache: %d hits, %d misses.', metrics.counters.get('cache_hits', 0),
+                     metrics.counters.get('cache_misses', 0))
+
+
+class MailboxCache:
+    # Batch lookups used by the fetch functions and archive readers for the messages of one source.  uidvalidity is
+    # None for archives, whose message numbers are not stable enough to be cached.
+    def __init__(self, cache, source, uidvalidity):
+        self.cache = cache
+        self.source = source
+        self.uidvalidity = uidvalidity
+
+    def by_uid(self, uids):
+        # {uid: (fields, received)} of the messages whose fields are cached for their uid.
+        if self.uidvalidity is None:
+            return {}
+        refs = {location_ref(self.source, self.uidvalidity, uid): uid for uid in uids}
+        found = self.cache.lookup(refs)
+        metrics.count('cache_hits', len(found))
+        return {refs[ref]: (fields, datetime.datetime.fromisoformat(received) if received else None)
+                for ref, (key, fields, received) in found.items()}
+
+    def by_message_id(self, message_ids, received):
+        # {uid: fields} of the messages whose fields are cached for their Message-ID, given {uid: Message-ID}.
+        refs = {message_id_ref(message_id): uid for uid, message_id in message_ids.items() if message_id}
+        found = self.cache.lookup(refs)
+        metrics.count('cache_hits', len(found))
+        self.remember({refs[ref]: key for ref, (key, fields, _) in found.items()}, received)
+        return {refs[ref]: fields for ref, (key, fields, _) in found.items()}
+
+    def by_html(self, htmls, received):
+        # {uid: fields} of the messages whose html is cached, given {uid: html}.
+        keys = {uid: content_key(html) for uid, html in htmls.items() if html}
+        found = self.cache.lookup_keys(set(keys.values()))
+        hits = {uid: key for uid, key in keys.items() if key in found}
+        metrics.count('cache_hits', len(hits))
+        metrics.count('cache_misses', len(htmls) - len(hits))
+        self.remember(hits, received)
+        return {uid: found[key] for uid, key in hits.items()}
+
+    def remember(self, keys, received):
+        # Record where the messages found by Message-ID or html are stored, so the next lookup succeeds by uid.
+        if self.uidvalidity is None or not keys:
+            return
+        self.cache.add_refs(
+            (location_ref(self.source, self.uidvalidity, uid), key,
+             received[uid].isoformat(sep=' ', timespec='seconds') if received.get(uid) else None)
+            for uid, key in keys.items())
@@ -1,199 +1,363 @@
-from imap_tools import MailBox, AND
-from bs4 import BeautifulSoup
-from copy import deepcopy
+from applicant import Applicant, blank_row, label_position
+from applicant_store import ApplicantStore
+from async_ingest import ingest_mailboxes, retry_errors
+from dedup import DuplicateIndex
+from form_extractor import extract_fields
+from imap_fetch import connect_mailbox, fetch_message_batches, fetch_html_batches, wait_for_mail
+from mail_sources import archive_batches
+from normalization import LayoutPlans
+from parse_cache import ParseCache
+from results_export import ResultsExport, archive_key
+from session_routing import SessionRouter, certifying_ves
+from sync_state import save_json, mailbox_key, load_sync_state, find_new_uids, advance_checkpoint, restore_checkpoints
+from trace_logging import worker_logging_options
+from uls_index import LicenseCheck, open_uls_index
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
 import config as cfg
-import csv
-import datetime
+import functools
 import logging
+import metrics
+import os
+import re
+import sys
+import time
 
 # define global variables
-results = []  # holds a list of applicants retrieved from the email form.
-applicant = {}  # Used to hold applicant data after extracting it from the email form
-fields = list(cfg.Header.fields.values()) # List of column headers for csv file
-CERTIFYING_VES = 'CERTIFYING_VES'
-
-# Setup logging and logfile
-log_filename = datetime.datetime.now().strftime("%m%d%Y_%H%M%S") + "_script_trace.log"
-logging.basicConfig(filename=log_filename, level=logging.DEBUG)
+# Row positions of the columns the normalization sets on its own.
+PREVIOUS_APPLICATION = label_position['PREVIOUS_APPLICATION']
+CERTIFYING_VES = label_position['CERTIFYING_VES']
+# Clean up rules of cfg.Header.rules, compiled into a plan for every form layout that comes along.
+layouts = LayoutPlans(cfg.Header.rules, cfg.Header.aliases, cfg.Header.required,
+                      cfg.Header.ignored + ((cfg.Sessions.field,) if cfg.Sessions.field else ()))
+unsafe_characters = re.compile(r'[^\w.@-]+')
 
 
 # Functions
-def set_exams(exams):
-    # set_exams receives a list of exams the applicant is interested in taking.  The exams list will be parsed and
-    # the correct columns for the elements will be set.
-    # If element 3 and/or element 4 are selected, these selections should show up on the Applicant's
-    # registration form in Session Manager.
-
-    # Define column heading names to be used with the csv file.
-    req_element_3 = 'REQUESTED_ELEMENT_3'
-    req_element_4 = 'REQUESTED_ELEMENT_4'
-
-    # loop through each exam and set corresponding element name and value.
-    for exam in exams:
-        print(f'exam is: {exam}')
-        match exam:
-            case 'Element 2 (Technician)':
-                if len(exams) == 1:
-                    applicant[cfg.Header.fields[req_element_3]] = False
-                    applicant[cfg.Header.fields[req_element_4]] = False
-            case 'Element 3 (General)':
-                applicant[cfg.Header.fields[req_element_3]] = True
-                applicant[cfg.Header.fields[req_element_4]] = False
-            case 'Element 4 (Amateur Extra)':
-                if len(exams) == 1:
-                    applicant[cfg.Header.fields[req_element_3]] = False
-                    applicant[cfg.Header.fields[req_element_4]] = True
-                else:
-                    applicant[cfg.Header.fields[req_element_4]] = True
-
-    return None
-
-
-def export_results_to_csv():
-    print('Enter export results to csv function')
-    print(f'fields: {fields}')
-    print(f'Results: {results}')
-    csv_filename = datetime.datetime.now().strftime("%m%d%Y_%H%M%S") + "_session_import.csv"
-    logging.info(f'Exporting application results to file: {csv_filename}.')
-    # open file and write
-    with open(csv_filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fields)
-        writer.writeheader()
-        for item in results:
-            writer.writerow(item)
-    logging.info('Finished exporting results to csv file.')
+def add_certifying_ves_to_applicant_data(applicant):
+    applicant[CERTIFYING_VES] = certifying_ves(cfg.VE.team)
 
 
-def add_certifying_ves_to_applicant_data():
-    delim = '~'
-    ve1 = cfg.VE.one.upper()
-    ve2 = cfg.VE.two.upper()
-    ve3 = cfg.VE.three.upper()
+def normalize_fields(fields):
+    # Turn the field name/value pairs of a form into the applicant's csv row, applying the clean up rules.  Returns
+    # None for a form of an unknown layout.
+    plan = layouts.plan(tuple(name for name, _ in fields))
+    if plan is None:
+        return None
+    applicant = Applicant()
+    # The per-field trace is only written at DEBUG level, see cfg.Logging.
+    trace = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for rule, (name, value) in zip(plan, fields):
+        if trace:
+            logging.debug('Performing pre-checks on: %s, %s', name, value)
+        rule.row(applicant, value)
 
-    applicant[cfg.Header.fields[CERTIFYING_VES]] = ve1 + delim + ve2 + delim + ve3
+    # Default PREVIOUS_APPLICATION to No
+    applicant[PREVIOUS_APPLICATION] = 'No'
+    # Add certifying VEs to applicant's data.
+    add_certifying_ves_to_applicant_data(applicant)
+    if trace:
+        logging.debug('Applicant: %s', applicant)
+    return applicant
 
 
-# main code
-def main():
-    logging.info(f'Logging into Mail Server: {cfg.Mail.server}.')
-    mb = MailBox(cfg.Mail.server).login(cfg.Mail.user, cfg.Mail.password)
+def normalize_batch(extracted):
+    # normalize_fields() for a list of forms, one column at a time.  Forms are grouped by their label sequence, the
+    # values of each label are cleaned up as one column and the rows are put together at the end.  Returns the
+    # applicants in the order of extracted, None for forms of an unknown layout.
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        # the per-field trace is written row by row
+        return [normalize_fields(fields) for fields in extracted]
+    batch_layouts = {}
+    for index, fields in enumerate(extracted):
+        batch_layouts.setdefault(tuple(name for name, _ in fields), []).append(index)
+
+    applicants = [None] * len(extracted)
+    for labels, indexes in batch_layouts.items():
+        plan = layouts.plan(labels)
+        if plan is None:
+            continue
+        count = len(indexes)
+        columns = [None] * len(blank_row)
+        if labels:
+            for rule, values in zip(plan, zip(*([value for _, value in extracted[index]] for index in indexes))):
+                rule.column(columns, values)
+        columns[PREVIOUS_APPLICATION] = ['No'] * count
+        columns[CERTIFYING_VES] = [certifying_ves(cfg.VE.team)] * count
+        columns = [column if column is not None else [''] * count for column in columns]
+        for index, row in zip(indexes, zip(*columns)):
+            applicants[index] = Applicant(row)
+    return applicants
+
+
+def quarantine_forms(checkpoint, unknown):
+    # Keep the (message, fields) of forms of unknown layouts for a look by hand instead of importing them.
+    logging.warning('Skipped %d forms of an unknown layout in %s.', len(unknown), checkpoint['key'])
+    metrics.count('parse_failures', len(unknown))
+    if not cfg.Quarantine.directory:
+        return
+    os.makedirs(cfg.Quarantine.directory, exist_ok=True)
+    prefix = unsafe_characters.sub('_', checkpoint['key'])
+    for msg, fields in unknown:
+        filename = os.path.join(cfg.Quarantine.directory, f'{prefix}_{msg.uid}.json')
+        save_json(filename, {'source': checkpoint['key'], 'uidvalidity': checkpoint['uidvalidity'], 'uid': msg.uid,
+                             'received': msg.received.isoformat(sep=' ') if msg.received else None,
+                             'message_id': msg.message_id, 'fields': fields, 'html': msg.html})
+        logging.warning('Quarantined form %s.', filename)
+
+
+def parse_batch(htmls):
+    # CPU stage for a list of forms, used by the asyncio ingestion to parse a chunk of a batch in one worker task.
+    # extract_fields() returns the field name/value pairs of the form table in form order.  The pairs are normalized
+    # in the main process, so forms taken from the parse cache go through the current normalization rules as well.
+    return [extract_fields(html) for html in htmls]
 
-    logging.info('Fetching application registration forms from mail server.')
-    messages = mb.fetch(criteria=AND(from_="burst@emailmeform.com", seen=False), mark_seen=True, bulk=True)
 
-    # Start processing retrieved applications
+def create_parse_executor():
+    # Process pool for the CPU stage, or None to parse in this process when cfg.Parse.workers is 1.  The workers log
+    # through the trace log queue when trace logging is running.
+    if cfg.Parse.workers == 1:
+        return None
+    return ProcessPoolExecutor(max_workers=cfg.Parse.workers, **worker_logging_options())
+
+
+def process_batches(batches, executor, write_batch, checkpoint):
+    # Run the pipeline over batches of messages from any source.  The IO stage (fetching or reading the html of a
+    # batch) runs in this process while the CPU stage (parsing and normalizing the previous batch) runs in the process
+    # pool.  executor.map hands the forms to the workers in chunks of cfg.Parse.chunk_size and returns the fields
+    # in message order, so the csv file always lists them in source order.  Forms found in the parse cache already
+    # carry their fields and skip the pool.
     logging.info('Application processing started...')
-    logging.info('Processing first applicant')
-    for msg in messages:
-        # logging.info('Processing next applicant')
-        # parse html email message
-        bs = BeautifulSoup(msg.html, 'html.parser')
-        # emailme form data resides in a html table.
-        # get all table rows
-        table_rows = bs.find('table').findAll('tr')
-        # process each row to get the table data.
-        for row in table_rows:
-            print(f'row: {row}')
-            name = ""
-            value = ""
-            td = row.findAll('td')
-
-            # parse each row to get the field name and field value.
-            # field name will contain '*:' and the will need to be stripped out.
-            # the first td item should be the field name with *:, ex first name*:
-            # the second td item should be the value
-            logging.info('\n')
-            for item in td:
-                if item.text.find("*:") != -1:
-                    name = item.text.strip().replace("*:", "")
-                else:
-                    value = item.text.strip()
-            # before adding the name/value pair to the applicant dict, check for required modifications.
-            logging.info(f'Performing pre-checks on: {name}, {value} ')
-
-            match name:
-                case 'Middle Initial':
-                    if value.upper() == 'NONE':
-                        # If Middle Initial is NONE, set value to empty string
-                        logging.info('Middle Initial was set to NONE, replacing with empty string')
-                        applicant[cfg.Header.fields[name]] = ''
-                case 'Suffix':
-                    if value.upper() == 'NONE':
-                        # If Suffix is NONE, set value to empty string
-                        logging.info('Suffix was set to NONE, replacing with empty string')
-                        applicant[cfg.Header.fields[name]] = ''
-                case 'Street Address':
-                    if value.find('PO') == -1:
-                        # Not a PO Box, add empty PO Box entry
-                        applicant[cfg.Header.fields[name]] = value
-                        applicant[cfg.Header.fields['PO Box']] = ''
-                    else:
-                        # PO Box, set Street Address(value) to empty string and add PO_BOX
-                        applicant[cfg.Header.fields['PO Box']] = value
-                        applicant[cfg.Header.fields[name]] = ''
-                case 'Callsign':
-                    if value.upper() == 'NOCALL':
-                        # If callsign is NOCALL, set Callsign value to empty string and set UPGRADE_LICENSE to False
-                        logging.info('Callsign was sent to NONE, replacing with empty string.')
-                        applicant[cfg.Header.fields[name]] = ''
-                        applicant[cfg.Header.fields['UPGRADE_LICENSE']] = False
-                    elif value.isalnum():
-                        # If a callsign was entered, set UPGRADE_LICENSE to True and convert callsign to upper case
-                        logging.info(f'Callsign: {value.strip()} was detected, setting UPGRADE_LICENSE to true.')
-                        applicant[cfg.Header.fields['UPGRADE_LICENSE']] = True
-                        applicant[cfg.Header.fields[name]] = value.upper()
-                    else:
-                        # callsign was entered wrong, needs checked
-                        applicant[cfg.Header.fields[name]] = 'ERROR'
-                        applicant[cfg.Header.fields['UPGRADE_LICENSE']] = False
-                case 'Exams':
-                    # Add exams to applicant data
-                    set_exams(value.split(', '))
-                    # add exams to Notes field
-                    applicant[cfg.Header.fields[name]] = value
-                case 'City':
-                    # Correct formatting.  Capitalize first letter only.
-                    logging.info(f'Converting City: {value.strip()} to capitalize first letter only.')
-                    applicant[cfg.Header.fields[name]] = value.lower().capitalize()
-                case 'State':
-                    # Convert state to all upper case.
-                    logging.info(f'Converting State: {value.strip()} to upper case.')
-                    applicant[cfg.Header.fields[name]] = value.upper()
-                case other:
-                    # No changes needed, write current values
-                    logging.info(f'{value} : No changes were needed.')
-                    applicant[cfg.Header.fields[name]] = value
-
-            logging.info(f'Name: {name}, Value: {value}')
-            logging.info('-' * 40)
-
-        # Default PREVIOUS_APPLICATION to No
-        applicant[cfg.Header.fields['PREVIOUS_APPLICATION']] = 'No'
-        # Add certifying VEs to applicant's data.
-        add_certifying_ves_to_applicant_data()
-        logging.info('Printing Applicant data...\n')
-        logging.info(f'Applicant: {applicant}\n')
-        # print('Print applicant data')
-        # print(applicant)
-        # print('Add application to results list')
-        logging.info('Adding applicant to results file.')
-        results.append(deepcopy(applicant))
-        applicant.clear()
-        logging.info('Processing next applicant')
+    parse = functools.partial(executor.map, chunksize=cfg.Parse.chunk_size) if executor else map
+    pending = None
+    for messages in batches:
+        extracted = parse(extract_fields, [msg.html for msg in messages if msg.fields is None])
+        if pending is not None:
+            write_parsed_batch(write_batch, checkpoint, *pending)
+        pending = (messages, extracted)
+    if pending is not None:
+        write_parsed_batch(write_batch, checkpoint, *pending)
+
+
+def write_parsed_batch(write_batch, checkpoint, messages, extracted):
+    # Collect the fields of a batch from the parse, then write it.  The wait is the parse stage of the run metrics.
+    with metrics.timed('parse'):
+        extracted = list(extracted)
+    write_batch(checkpoint, messages, extracted)
+
+
+def ingest_mailbox(sync_state, executor, write_batch, finish_checkpoint, cache):
+    # Read the new registration forms of the single mailbox in cfg.Mail.
+    logging.info('Logging into Mail Server: %s.', cfg.Mail.server)
+    mb = connect_mailbox(cfg.Mail.server, cfg.Mail.user, cfg.Mail.password, folder=cfg.Mail.folder,
+                         port=cfg.Mail.port, ssl=cfg.Mail.ssl)
+
+    # Only the UIDs of new forms are retrieved up front.  The registration forms themselves are fetched in batches of
+    # cfg.Mail.batch_size, and each applicant is written to the csv file as soon as it is parsed, so memory use stays
+    # flat no matter how many forms are waiting.
+    logging.info('Searching mail server for application registration forms.')
+    sync_key = mailbox_key(cfg.Mail.server, cfg.Mail.user, cfg.Mail.folder)
+    uids, checkpoint = find_new_uids(mb, cfg.Mail.folder, sync_state, sync_key, cfg.Sync.state_file)
+
+    fetch_batches = fetch_html_batches if cfg.Mail.lean_fetch else fetch_message_batches
+    cached = cache.mailbox(sync_key, checkpoint['uidvalidity']) if cache is not None else None
+    process_batches(fetch_batches(mb, uids, cfg.Mail.batch_size, mark_seen=False, cached=cached), executor,
+                    write_batch, checkpoint)
+    finish_checkpoint(checkpoint)
 
     # Logout of mailbox
     logging.info('Logging out of Mailbox.')
     mb.logout()
-    # print('Results List')
-    # print(results)
-    # print('Export applicants to csv')
-    export_results_to_csv()
 
 
-if __name__ == '__main__':
-    logging.info(f'{datetime.datetime.now()} ===================================')
-    logging.info('Application export process starting')
+def serve_mailbox(sync_state, executor, write_batch, finish_checkpoint, cache, publish):
+    # serve mode: stay logged into the mailbox in cfg.Mail and process new registration forms as they arrive, until
+    # the process is stopped.  The parse workers, caches and indexes stay warm between forms.  After every round the
+    # import file is published, then the connection waits in IMAP IDLE for the next form.
+    sync_key = mailbox_key(cfg.Mail.server, cfg.Mail.user, cfg.Mail.folder)
+    fetch_batches = fetch_html_batches if cfg.Mail.lean_fetch else fetch_message_batches
+    backoff = cfg.Serve.backoff
+    while True:
+        mb = None
+        try:
+            logging.info('Logging into Mail Server: %s.', cfg.Mail.server)
+            mb = connect_mailbox(cfg.Mail.server, cfg.Mail.user, cfg.Mail.password, folder=cfg.Mail.folder,
+                                 port=cfg.Mail.port, ssl=cfg.Mail.ssl)
+            connected = time.monotonic()
+            while time.monotonic() - connected < cfg.Serve.reconnect_interval:
+                uids, checkpoint = find_new_uids(mb, cfg.Mail.folder, sync_state, sync_key, cfg.Sync.state_file)
+                cached = cache.mailbox(sync_key, checkpoint['uidvalidity']) if cache is not None else None
+                process_batches(fetch_batches(mb, uids, cfg.Mail.batch_size, mark_seen=False, cached=cached),
+                                executor, write_batch, checkpoint)
+                finish_checkpoint(checkpoint)
+                publish()
+                backoff = cfg.Serve.backoff
+                wait_for_mail(mb, cfg.Serve.idle_timeout)
+            logging.info('Logging out of Mailbox to reconnect.')
+            mb.logout()
+        except retry_errors as e:
+            # the forms written before the error are kept and their checkpoint moves past them
+            publish()
+            if mb is not None:
+                try:
+                    mb.box.shutdown()
+                except Exception:  # noqa the connection is already broken, nothing more to do
+                    pass
+            logging.warning('Connection to %s failed (%r), reconnecting in %d seconds.', cfg.Mail.server, e, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, cfg.Serve.max_backoff)
+
+
+# main code
+def main(source_kind=None, source_path=None, serve=False):
+    # source_kind and source_path default to cfg.Source, see config.py for the available kinds.  serve keeps
+    # processing new forms of the cfg.Mail mailbox until the process is stopped, the export then stays open and the
+    # next run appends to it.
+    source_kind = source_kind or cfg.Source.kind
+    source_path = source_path or cfg.Source.path
+    sync_state = load_sync_state(cfg.Sync.state_file)
+
+    store = ApplicantStore(cfg.Store.database) if cfg.Store.database else None
+    duplicates = DuplicateIndex(cfg.Dedup.index_file) if cfg.Dedup.index_file else None
+    cache = ParseCache(cfg.Cache.cache_file, cfg.Cache.max_bytes) if cfg.Cache.cache_file else None
+    uls = open_uls_index(cfg.Uls.dump_dir, cfg.Uls.index_file) if cfg.Uls.dump_dir else None
+    license_check = LicenseCheck(uls) if uls is not None else None
+    router = SessionRouter(cfg.Sessions.sessions, cfg.Sessions.field) if cfg.Sessions.sessions else None
+
+    def advance(checkpoint, uid):
+        # Called by the export once the rows up to uid are on disk.  Archive positions only live in the journal.
+        if checkpoint['uidvalidity'] is not None:
+            advance_checkpoint(cfg.Sync.state_file, sync_state, checkpoint, uid)
+
+    def sync():
+        # Commit the other copies of the exported rows before the export journals them.
+        if store is not None:
+            store.commit()
+        if cache is not None:
+            cache.commit()
+        if duplicates is not None:
+            duplicates.commit()
+
+    export = ResultsExport(cfg.Export.journal_file, advance, sync)
+    progress = export.open()
+    restore_checkpoints(cfg.Sync.state_file, sync_state, progress)
+    if duplicates is not None and progress:
+        duplicates.resume(export)
 
-    main()
-    logging.info('Application export process completed.')
-    logging.info(f'{datetime.datetime.now()} ===================================')
+    def write_batch(checkpoint, messages, extracted):
+        # Normalize and write the applicants of one batch to the files of their sessions, leaving out submissions
+        # superseded by a later one.  extracted holds the fields of the messages that were not found in the parse
+        # cache, in message order; they are added to the cache.  The checkpoint of its source moves past the batch
+        # once the rows are safely on disk.
+        forms = []
+        parsed = iter(extracted)
+        for msg in messages:
+            fields = msg.fields
+            if fields is None:
+                fields = next(parsed)
+                if cache is not None:
+                    cache.add(checkpoint, msg, fields)
+            forms.append(fields)
+        metrics.count('forms_parsed', len(extracted))
+        with metrics.timed('normalize'):
+            applicants = normalize_batch(forms)
+        uid = max((int(msg.uid) for msg in messages), default=None) if checkpoint['uidvalidity'] is not None else None
+        if None in applicants:
+            quarantine_forms(checkpoint, [(msg, fields) for msg, fields, applicant in zip(messages, forms, applicants)
+                                          if applicant is None])
+        if license_check is not None:
+            with metrics.timed('license_check'):
+                license_check.check(applicant for applicant in applicants if applicant is not None)
+
+        sessions = {}
+        for msg, fields, applicant in zip(messages, forms, applicants):
+            if applicant is not None:
+                session = router.route(fields, msg.received) if router is not None else None
+                if session is not None:
+                    applicant[CERTIFYING_VES] = router.ves[session]
+                session_messages, session_applicants = sessions.setdefault(session, ([], []))
+                session_messages.append(msg)
+                session_applicants.append(applicant)
+
+        written = {}
+        for session, (session_messages, session_applicants) in sessions.items():
+            if store is not None:
+                with metrics.timed('store'):
+                    store.add(checkpoint, session_messages, session_applicants, session or cfg.Store.session)
+            if duplicates is not None:
+                with metrics.timed('dedup'):
+                    session_messages, session_applicants, superseded = duplicates.check(
+                        checkpoint, session_messages, session_applicants, export, session)
+                if store is not None:
+                    store.supersede(superseded)
+            written[session] = session_applicants
+        export.write_sessions(written, checkpoint, uid, [msg.uid for msg in messages])
+        logging.info('Added %d applicants to results file.', sum(map(len, written.values())))
+
+    def finish_checkpoint(checkpoint):
+        # Every form that was on the server when the mailbox was searched has been written.
+        export.write((), checkpoint, checkpoint['final_uid'])
+
+    def publish():
+        # serve mode: after every round of new forms.  A daemon is only ever stopped, so the identities (committed
+        # with the export) and the reports are written after every round instead of when the run completes.
+        export.publish()
+        if duplicates is not None:
+            duplicates.write_report(export)
+        if license_check is not None:
+            license_check.write_report(export)
+        metrics.write_files('running')
+
+    executor = create_parse_executor()
+    status = 'failed'
+    try:
+        if serve:
+            serve_mailbox(sync_state, executor, write_batch, finish_checkpoint, cache, publish)
+        elif source_kind != 'imap':
+            key = archive_key(source_kind, source_path)
+            handled = set(progress.get(key, {}).get('handled', ()))
+            checkpoint = {'key': key, 'uidvalidity': None, 'last_uid': None}
+            cached = cache.mailbox(key, None) if cache is not None else None
+            batches = archive_batches(source_kind, source_path, cfg.Mail.batch_size, handled, cached)
+            process_batches(metrics.timed_batches('archive_read', batches), executor, write_batch, checkpoint)
+        elif cfg.Mailboxes.accounts:
+            logging.info('Reading %d intake mailboxes concurrently.', len(cfg.Mailboxes.accounts))
+            asyncio.run(ingest_mailboxes(cfg.Mailboxes.accounts, sync_state, executor, parse_batch, write_batch,
+                                         finish_checkpoint, cache))
+        else:
+            ingest_mailbox(sync_state, executor, write_batch, finish_checkpoint, cache)
+    except KeyboardInterrupt:
+        status = 'stopped'
+        export.close()
+        raise
+    except BaseException:
+        export.close()
+        raise
+    else:
+        export.finish()
+        if duplicates is not None:
+            duplicates.finish(export)
+        if license_check is not None:
+            license_check.finish(export)
+        status = 'completed'
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if store is not None:
+            store.close()
+        if duplicates is not None:
+            duplicates.close()
+        if cache is not None:
+            cache.close()
+        if license_check is not None:
+            license_check.close()
+        if router is not None:
+            router.close()
+        metrics.log_summary(status)
+        metrics.write_files(status)
+    logging.info('Finished exporting results to csv file.')
+
+if __name__ == '__main__':
+    # 'python process_applicant_registrations.py [run|serve] [options]' as before, the commands live in cli.py
+    import cli
+    sys.exit(cli.main(sys.argv[1:] if sys.argv[1:2] and not sys.argv[1].startswith('-') else ['run'] + sys.argv[1:]))
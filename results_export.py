@@ -0,0 +1,277 @@
+from applicant import columns
+from sync_state import save_json
+import config as cfg
+import csv
+import datetime
+import json
+import logging
+import metrics
+import os
+import re
+import time
+
+# Crash safe export of the Session Manager import files.  Applicants are appended to '<name>.part' batch by batch as
+# they are parsed.  Every cfg.Export.sync_interval seconds the part files are flushed and fsynced, and the journal
+# records how many bytes of each are complete together with the position of every source (mailbox folder or archive)
+# those bytes cover.  Only after that are the mailbox sync checkpoints moved forward.  When the run completes the
+# part files are renamed to <name> and the journal removed, so a finished import file is never half written.
+#
+# If a run stops early, the next run finds the journal, cuts the part files back to their last complete size and
+# keeps appending to them, starting every source after the position recorded in the journal.  Forms that made it
+# into a file before the crash are neither fetched nor parsed again.
+#
+# Rows can be dropped after they were written (a duplicate submission superseded by a later one).  Dropped rows are
+# journaled with the rest and left out when the part file is turned into the import file.
+#
+# A long running export (serve mode) publishes the import files after every round of new forms instead: the rows so
+# far are copied to <name>, and the part files and journal stay in place for the rows still to come.
+#
+# Applicants routed to an exam session (see session_routing.py) go to an import file of their own,
+# '<timestamp>_<session>_session_import.csv'.  All files of a run share the journal, so a batch that spans several
+# sessions becomes durable in all of them at once.
+
+# Bytes buffered in memory between writes to a part file.
+buffer_size = 1 << 16
+
+unsafe_characters = re.compile(r'[^\w.@-]+')
+
+
+def archive_key(kind, path):
+    # Key used to record the read position of an archive in the journal.
+    return f'{kind}:{os.path.abspath(path)}'
+
+
+def load_journal(journal_file):
+    if not os.path.exists(journal_file):
+        return None
+    with open(journal_file) as f:
+        return json.load(f)
+
+
+class ExportFile:
+    # The part file of one import file.  rows counts the rows written so far, dropped holds the rows to leave out.
+    def __init__(self, csv_filename, part_filename, rows=0, dropped=()):
+        self.csv_filename = csv_filename
+        self.part_filename = part_filename
+        self.rows = rows
+        self.dropped = set(dropped)
+        self.csvfile = None
+        self.writer = None
+
+    def create(self):
+        self.csvfile = open(self.part_filename, 'w', newline='', buffering=buffer_size)
+        self.writer = csv.writer(self.csvfile)
+        self.writer.writerow(columns)
+
+    def resume(self, size):
+        # rows after the last journaled size were never committed, their forms are processed again
+        os.truncate(self.part_filename, size)
+        self.csvfile = open(self.part_filename, 'a', newline='', buffering=buffer_size)
+        self.writer = csv.writer(self.csvfile)
+
+    def write(self, applicants):
+        applicants = list(applicants)
+        self.writer.writerows(applicants)
+        self.rows += len(applicants)
+        metrics.count('rows_written', len(applicants))
+
+    def drop(self, row):
+        # Leave row (counted from 0, without the header) out of the import file.
+        self.dropped.add(row)
+
+    def committed_rows(self):
+        # (row, values) of the rows already in the part file, except dropped ones.  Used when an export is resumed.
+        self.csvfile.flush()
+        with open(self.part_filename, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            for row, values in enumerate(reader):
+                if row not in self.dropped:
+                    yield row, values
+
+    def sync(self):
+        # Flush and fsync the part file, returns its journal entry.
+        self.csvfile.flush()
+        os.fsync(self.csvfile.fileno())
+        return {'csv_file': self.csv_filename, 'part_file': self.part_filename,
+                'size': os.fstat(self.csvfile.fileno()).st_size, 'rows': self.rows, 'dropped': sorted(self.dropped)}
+
+    def copy_without_dropped_rows(self):
+        tmp_filename = self.csv_filename + '.tmp'
+        with open(self.part_filename, newline='') as source, open(tmp_filename, 'w', newline='') as target:
+            reader = csv.reader(source)
+            writer = csv.writer(target)
+            writer.writerow(next(reader))
+            writer.writerows(values for row, values in enumerate(reader) if row not in self.dropped)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(tmp_filename, self.csv_filename)
+
+    def finish(self):
+        # Publish the import file under its final name.  With dropped rows the part file stays as the journal
+        # describes it until the import file is complete.
+        self.csvfile.close()
+        if self.dropped:
+            self.copy_without_dropped_rows()
+        else:
+            os.replace(self.part_filename, self.csv_filename)
+        logging.info('Exported %d applicants to %s.', self.rows - len(self.dropped), self.csv_filename)
+
+    def close(self):
+        self.csvfile.close()
+
+
+class ResultsExport:
+    def __init__(self, journal_file, advance, sync=None):
+        # advance(checkpoint, uid) is called for every source whose rows up to uid have become durable.  sync() is
+        # called before the journal is written, for other copies of the rows to be committed as well.
+        self.journal_file = journal_file
+        self.advance = advance
+        self.sync = sync
+        # Import file of the applicants without a session, its name is the base name of the run's reports as well.
+        self.csv_filename = None
+        self.timestamp = None
+        self.files = {}
+        self.progress = {}
+        self.pending = {}
+        self.last_sync = time.monotonic()
+        self.published = None
+
+    def open(self):
+        # Resume the export of an interrupted run or start a new one.  Returns the source positions of the journal,
+        # {key: {'uidvalidity': ..., 'last_uid': ...}} for mailboxes and {key: {'uidvalidity': None, 'handled': [...]}}
+        # with the uids of the messages written so far for archives, which is empty for a new export.
+        journal = load_journal(self.journal_file)
+        if journal is not None and 'files' not in journal:
+            # journal of a single file export
+            journal = {'timestamp': journal['csv_file'][:15], 'progress': journal['progress'], 'files': {'': journal}}
+        if journal is not None and all(os.path.exists(entry['part_file']) for entry in journal['files'].values()):
+            self.timestamp = journal['timestamp']
+            self.csv_filename = self.filename(None)
+            self.progress = journal['progress']
+            for session, entry in journal['files'].items():
+                export_file = ExportFile(entry['csv_file'], entry['part_file'], entry['rows'], entry['dropped'])
+                export_file.resume(entry['size'])
+                self.files[session or None] = export_file
+                logging.info('Resuming export to %s after %d applicants.', export_file.csv_filename,
+                             export_file.rows)
+            return self.progress
+
+        if journal is not None:
+            logging.warning('Export journal %s refers to missing files, starting a new export.', self.journal_file)
+        self.timestamp = datetime.datetime.now().strftime("%m%d%Y_%H%M%S")
+        self.csv_filename = self.filename(None)
+        self.file(None)
+        self.commit()
+        return self.progress
+
+    def filename(self, session):
+        if session is None:
+            return self.timestamp + "_session_import.csv"
+        return f'{self.timestamp}_{unsafe_characters.sub("_", session)}_session_import.csv'
+
+    def report_filename(self, suffix):
+        # Name of a report of this run, e.g. report_filename('_duplicates.csv').
+        return os.path.splitext(self.csv_filename)[0] + suffix
+
+    def append_report(self, suffix, header, rows):
+        # Append rows to the report of this run with the given suffix, which starts with header.  Serve mode appends
+        # after every round and a resumed export continues the report of the interrupted run.  Returns its name.
+        report_filename = self.report_filename(suffix)
+        new_report = not os.path.exists(report_filename)
+        with open(report_filename, 'a', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            if new_report:
+                writer.writerow(header)
+            writer.writerows(rows)
+        return report_filename
+
+    def file(self, session):
+        # The ExportFile of a session, None for applicants without one.  Created on first use.
+        export_file = self.files.get(session)
+        if export_file is None:
+            csv_filename = self.filename(session)
+            export_file = self.files[session] = ExportFile(csv_filename, csv_filename + '.part')
+            export_file.create()
+            logging.info('Exporting application results to file: %s.', csv_filename)
+        return export_file
+
+    def find_file(self, csv_filename):
+        # The ExportFile of this run with the given import file name, or None.
+        for export_file in self.files.values():
+            if export_file.csv_filename == csv_filename:
+                return export_file
+        return None
+
+    def write(self, applicants, checkpoint=None, uid=None, session=None):
+        # Append the applicants of one batch to the file of session.  checkpoint and uid record that the batch
+        # completes its source up to uid; that position is journaled and handed to advance() with the next commit.
+        self.write_sessions({session: applicants}, checkpoint, uid)
+
+    def write_sessions(self, sessions, checkpoint=None, uid=None, handled=()):
+        # write() for a batch routed to several sessions, {session: applicants}.  Archives have no position to
+        # record, for them handled lists the uids of the batch's messages (see mail_sources.archive_uid()).
+        with metrics.timed('csv_write'):
+            for session, applicants in sessions.items():
+                self.file(session).write(applicants)
+        if checkpoint is not None and checkpoint['uidvalidity'] is None:
+            self.progress.setdefault(checkpoint['key'], {'uidvalidity': None, 'handled': []})['handled'] += handled
+        elif checkpoint is not None and uid is not None:
+            key = checkpoint['key']
+            entry = self.progress.get(key)
+            if entry is None or entry['uidvalidity'] != checkpoint['uidvalidity'] or entry['last_uid'] < uid:
+                self.progress[key] = {'uidvalidity': checkpoint['uidvalidity'], 'last_uid': uid}
+            self.pending[key] = (checkpoint, self.progress[key]['last_uid'])
+        if time.monotonic() - self.last_sync >= cfg.Export.sync_interval:
+            self.commit()
+
+    def commit(self):
+        # Make everything written so far durable, journal it, then let the sources move their checkpoints.
+        with metrics.timed('commit'):
+            files = {session or '': export_file.sync() for session, export_file in self.files.items()}
+            if self.sync is not None:
+                self.sync()
+            save_json(self.journal_file, {'timestamp': self.timestamp, 'files': files, 'progress': self.progress})
+        pending = self.pending
+        self.pending = {}
+        for checkpoint, uid in pending.values():
+            self.advance(checkpoint, uid)
+        self.last_sync = time.monotonic()
+
+    def publish(self):
+        # Make the rows written so far available under the final names, if anything changed since the last time.
+        state = {session: (export_file.rows, len(export_file.dropped)) for session, export_file in self.files.items()}
+        if self.published == state:
+            return
+        self.commit()
+        for session, export_file in self.files.items():
+            if self.published is None or self.published.get(session) != state[session]:
+                export_file.copy_without_dropped_rows()
+                logging.info('Published %d applicants to %s.', export_file.rows - len(export_file.dropped),
+                             export_file.csv_filename)
+        self.published = state
+
+    def finish(self):
+        # The run completed: publish the import files under their final names and drop the journal.  The file of
+        # the applicants without a session is left out if it stayed empty while sessions got applicants.
+        self.commit()
+        for session, export_file in self.files.items():
+            if session is None and export_file.rows == 0 and len(self.files) > 1:
+                export_file.close()
+            else:
+                export_file.finish()
+        os.remove(self.journal_file)
+        for export_file in self.files.values():
+            if os.path.exists(export_file.part_filename):
+                os.remove(export_file.part_filename)
+
+    def close(self):
+        # The run failed: keep what was written so far for the next run to resume.
+        try:
+            self.commit()
+        finally:
+            for export_file in self.files.values():
+                export_file.close()
+        for export_file in self.files.values():
+            logging.warning('Export to %s stopped after %d applicants, the next run resumes it.',
+                            export_file.csv_filename, export_file.rows)
@@ -0,0 +1,61 @@
+import datetime
+import logging
+
+# Routing of applicants to exam sessions.  Each session in cfg.Sessions.sessions gets its own import file with its
+# own VE team as CERTIFYING_VES, so a backlog of forms for several sessions is fetched and parsed once.  A session
+# is recognized by
+#   the form field cfg.Sessions.field, if the form has one: its value is the session name or one of the session's
+#                                     'match' values, compared without case and extra spaces.
+#   the receipt date of the form:     forms received from the session's 'since' date up to, not including, its
+#                                     'before' date (YYYY-MM-DD, either may be left out).
+# The form field wins over the date.  Applicants that match no session go to the import file without a session and
+# get the VE team of cfg.VE.
+
+
+def choice_key(value):
+    return ' '.join(str(value).casefold().split())
+
+
+def certifying_ves(team):
+    # CERTIFYING_VES value of a VE team, any number of callsigns separated by '~'.
+    return '~'.join(ve.upper() for ve in team)
+
+
+class SessionRouter:
+    def __init__(self, sessions, field):
+        self.field = field
+        self.choices = {}
+        self.windows = []
+        self.ves = {}
+        for name, session in sessions.items():
+            for value in (name, *session.get('match', ())):
+                self.choices[choice_key(value)] = name
+            since = session.get('since')
+            before = session.get('before')
+            if since is not None or before is not None:
+                self.windows.append((datetime.date.fromisoformat(since) if since else datetime.date.min,
+                                     datetime.date.fromisoformat(before) if before else datetime.date.max, name))
+            self.ves[name] = certifying_ves(session['ves'])
+        self.unrouted = 0
+
+    def route(self, fields, received):
+        # Session of a form given its (label, value) pairs and receipt time, None if it matches none.
+        if self.field is not None:
+            for name, value in fields:
+                if name == self.field:
+                    session = self.choices.get(choice_key(value))
+                    if session is not None:
+                        return session
+                    break
+        if received is not None:
+            day = received.date()
+            for since, before, name in self.windows:
+                if since <= day < before:
+                    return name
+        self.unrouted += 1
+        return None
+
+    def close(self):
+        if self.unrouted:
+            logging.warning('%d applicants matched no exam session, they are in the import file without a session.',
+                            self.unrouted)
@@ -0,0 +1,119 @@
+import datetime
+import json
+import logging
+import os
+import threading
+
+# The sync state file remembers, for every mailbox folder the script reads from, the folder's UIDVALIDITY and the
+# highest message UID whose applicant has been written to the csv file.  The next run only has to search for
+# messages above that UID.  If the server reports a different UIDVALIDITY the old UIDs are meaningless and the
+# checkpoint is ignored.
+#
+# A folder without a checkpoint is read like the script did before checkpoints existed, by its unseen forms.  Before
+# any of them is fetched a provisional checkpoint just below the first one is saved, and the forms are fetched with
+# PEEK, so a run that fails half way leaves them unseen and the next run starts at the provisional checkpoint instead
+# of losing them.  (That run reads every form above it, also ones that were already seen.)  After a UIDVALIDITY change
+# the seen flags tell nothing, the forms in the cfg.Search window received since the day of the old checkpoint are
+# read instead.
+
+state_lock = threading.Lock()
+
+
+def mailbox_key(server, user, folder):
+    # Key used to store the checkpoint of a single mailbox folder in the state file.
+    return f'{user}@{server}/{folder}'
+
+
+def load_sync_state(state_file):
+    # Load all checkpoints from the state file.  A missing file means no mailbox has been synced yet.
+    if not os.path.exists(state_file):
+        logging.info('Sync state file %s does not exist yet.', state_file)
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def get_checkpoint(state, key, uidvalidity):
+    # Return the highest processed UID for the mailbox, or None if there is no usable checkpoint.
+    checkpoint = state.get(key)
+    if checkpoint is None:
+        logging.info('No sync checkpoint found for %s.', key)
+        return None
+    if checkpoint['uidvalidity'] != uidvalidity:
+        logging.warning('UIDVALIDITY of %s changed from %s to %s, ignoring sync checkpoint.', key,
+                        checkpoint['uidvalidity'], uidvalidity)
+        return None
+    return checkpoint['last_uid']
+
+
+def save_json(filename, data):
+    # Write data to a temporary file and rename it over filename, so a crash never leaves a half written file behind.
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def save_checkpoint(state_file, state, key, uidvalidity, last_uid):
+    # Record last_uid as the highest processed UID of the mailbox.  Provisional checkpoints are saved from the IMAP
+    # threads of the asyncio ingestion, hence the lock.
+    with state_lock:
+        state[key] = {'uidvalidity': uidvalidity, 'last_uid': last_uid, 'date': datetime.date.today().isoformat()}
+        save_json(state_file, state)
+    logging.info('Sync checkpoint for %s advanced to UID %s.', key, last_uid)
+
+
+def restore_checkpoints(state_file, state, progress):
+    # Bring the checkpoints up to the mailbox positions recorded in the journal of an interrupted export, in case the
+    # run stopped after writing the journal but before saving the state file.  Archive positions have no uidvalidity
+    # and are not mailbox checkpoints.
+    for key, position in progress.items():
+        if position['uidvalidity'] is None:
+            continue
+        checkpoint = state.get(key)
+        if (checkpoint is None or checkpoint['uidvalidity'] != position['uidvalidity']
+                or checkpoint['last_uid'] < position['last_uid']):
+            save_checkpoint(state_file, state, key, position['uidvalidity'], position['last_uid'])
+
+
+def find_new_uids(mb, folder, state, key, state_file=None):
+    # Work out which registration forms in folder are new since the last run.  Returns the UIDs to process and the
+    # checkpoint dict that advance_checkpoint() moves forward as batches are written.  The forms are to be fetched
+    # without marking them seen.  The provisional checkpoint of a folder without one is saved to state_file, None
+    # only looks (dry-run).
+    # imported here, so the commands that only read the sync state start without loading imap_tools
+    from imap_fetch import search_uids, registration_search_criteria
+    from imap_tools import UidRange
+    status = mb.folder.status(folder, ['UIDVALIDITY', 'UIDNEXT'])
+    uidvalidity = status['UIDVALIDITY']
+    last_uid = get_checkpoint(state, key, uidvalidity)
+    if last_uid is None:
+        # Everything already on the server when the run started counts as handled once the run completes.
+        old_checkpoint = state.get(key)
+        if old_checkpoint is None:
+            uids = search_uids(mb, registration_search_criteria(seen=False))
+        else:
+            since = datetime.date.fromisoformat(old_checkpoint['date']) if 'date' in old_checkpoint else None
+            logging.warning('Reading the forms of %s received since %s.', key, since or 'the start of cfg.Search')
+            uids = search_uids(mb, registration_search_criteria(since=since))
+        final_uid = status['UIDNEXT'] - 1
+        last_uid = min(int(uid) for uid in uids) - 1 if uids else final_uid
+        if state_file is not None:
+            save_checkpoint(state_file, state, key, uidvalidity, last_uid)
+    else:
+        # A UID range of n:* always contains the newest message, even if its UID is below n.
+        uids = search_uids(mb, registration_search_criteria(uid=UidRange(last_uid + 1, '*')))
+        uids = [uid for uid in uids if int(uid) > last_uid]
+        final_uid = last_uid
+    logging.info('Found %d application registration forms in %s.', len(uids), key)
+    checkpoint = {'key': key, 'uidvalidity': uidvalidity, 'last_uid': last_uid, 'final_uid': final_uid}
+    return uids, checkpoint
+
+
+def advance_checkpoint(state_file, state, checkpoint, uid):
+    # Move the checkpoint of a mailbox forward to uid, once everything up to uid has been written.
+    if checkpoint['last_uid'] is None or uid > checkpoint['last_uid']:
+        checkpoint['last_uid'] = uid
+        save_checkpoint(state_file, state, checkpoint['key'], checkpoint['uidvalidity'], uid)
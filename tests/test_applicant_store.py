@@ -0,0 +1,36 @@
+from applicant import columns
+from applicant_store import ApplicantStore
+from imap_fetch import HtmlMessage
+import datetime
+
+
+def applicant(number):
+    return [f'{column.lower()}{number}' for column in columns]
+
+
+def message(uid, number, message_id=True):
+    return HtmlMessage(str(uid), None, datetime.datetime(2024, 1, 1, 0, number),
+                       f'<registration-{number}@emailmeform.com>' if message_id else None)
+
+
+def test_form_read_again_after_uidvalidity_change_replaces_its_row(tmp_path):
+    store = ApplicantStore(str(tmp_path / 'applicants.sqlite3'))
+    store.add({'key': 'inbox', 'uidvalidity': 1}, [message(number + 1, number) for number in range(8)],
+              [applicant(number) for number in range(8)])
+    # the same messages come back with new UIDs, and one new form
+    store.add({'key': 'inbox', 'uidvalidity': 2}, [message(number + 11, number) for number in range(9)],
+              [applicant(number) for number in range(9)])
+    store.commit()
+    assert [row[0] for row in store.select()] == [f'first_name{number}' for number in range(9)]
+    store.close()
+
+
+def test_forms_without_message_id_are_keyed_by_uid(tmp_path):
+    store = ApplicantStore(str(tmp_path / 'applicants.sqlite3'))
+    checkpoint = {'key': 'inbox', 'uidvalidity': 1}
+    store.add(checkpoint, [message(1, 0, False), message(2, 1, False)], [applicant(0), applicant(1)])
+    store.add(checkpoint, [message(2, 1, False)], [applicant(2)])
+    store.supersede([('inbox', 1, 1, None)])
+    store.commit()
+    assert [row[0] for row in store.select()] == ['first_name2']
+    store.close()
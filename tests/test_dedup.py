@@ -0,0 +1,110 @@
+from applicant_store import ApplicantStore
+from local_imap import LocalImapServer
+import benchmark
+import config as cfg
+import csv
+import datetime
+import email.utils
+import glob
+import process_applicant_registrations
+import pytest
+import random
+import re
+import time
+
+# Forms that reach the pipeline more than once as the same message must end up in Session Manager once: a copy
+# delivered twice, a form that reaches two intake mailboxes, and the forms read again after a UIDVALIDITY change.
+
+
+def form(number):
+    # A registration form dated today, so it falls into the search window of a UIDVALIDITY change.
+    raw = benchmark.generate_form_email(random.Random(number), number)
+    date = email.utils.format_datetime(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1))
+    return re.sub(rb'\nDate: [^\n]*', b'\nDate: ' + date.encode(), raw, count=1)
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for setting, value in (('server', '127.0.0.1'), ('ssl', False), ('user', 'user'), ('password', 'password'),
+                           ('batch_size', 4)):
+        monkeypatch.setattr(cfg.Mail, setting, value)
+    monkeypatch.setattr(cfg.Parse, 'workers', 1)
+    monkeypatch.setattr(cfg.Export, 'sync_interval', 0)
+    monkeypatch.setattr(cfg.Quarantine, 'directory', None)
+    servers = []
+
+    def server(uidvalidity=1):
+        servers.append(LocalImapServer(uidvalidity=uidvalidity).start())
+        return servers[-1]
+
+    def run(imap_server=None):
+        if imap_server is not None:
+            monkeypatch.setattr(cfg.Mail, 'port', imap_server.port)
+        before = set(glob.glob('*_session_import.csv'))
+        process_applicant_registrations.main()
+        # import files are named after the second the run started
+        time.sleep(1.1)
+        export, = set(glob.glob('*_session_import.csv')) - before
+        with open(export, newline='') as csvfile:
+            return list(csv.reader(csvfile))[1:]
+
+    yield server, run
+    for imap_server in servers:
+        imap_server.stop()
+
+
+def duplicate_report():
+    reports = glob.glob('*_duplicates.csv')
+    if not reports:
+        return []
+    with open(reports[0], newline='') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def test_copy_delivered_twice_is_written_once(pipeline):
+    server, run = pipeline
+    imap_server = server()
+    for number in range(10):
+        imap_server.add_message(form(number))
+    for number in range(3):
+        imap_server.add_message(form(number))
+    rows = run(imap_server)
+    assert len(rows) == 10
+    assert len({tuple(row) for row in rows}) == 10
+    assert [entry['action'] for entry in duplicate_report()] == ['second copy of the same message, left out'] * 3
+
+
+def test_form_in_two_intake_mailboxes_is_written_once(pipeline, monkeypatch):
+    server, run = pipeline
+    first, second = server(), server()
+    for number in range(5):
+        first.add_message(form(number))
+    for number in range(3, 8):
+        second.add_message(form(number))
+    monkeypatch.setattr(cfg.Mailboxes, 'accounts', [
+        {'server': '127.0.0.1', 'port': imap_server.port, 'ssl': False, 'user': 'user', 'password': 'password'}
+        for imap_server in (first, second)])
+    rows = run()
+    assert len(rows) == 8
+    assert len(duplicate_report()) == 2
+
+
+def test_uidvalidity_change_does_not_export_forms_again(pipeline):
+    server, run = pipeline
+    imap_server = server(uidvalidity=1)
+    for number in range(8):
+        imap_server.add_message(form(number))
+    exported = run(imap_server)
+    assert len(exported) == 8
+
+    # the folder was rebuilt on the server, the same messages come back with new UIDs and one new form arrives
+    imap_server = server(uidvalidity=2)
+    for number in range(9):
+        imap_server.add_message(form(number))
+    rows = run(imap_server)
+    assert len(rows) == 1 and rows[0] not in exported
+    assert duplicate_report() == []
+    store = ApplicantStore(cfg.Store.database)
+    assert len(store.select().fetchall()) == 9
+    store.close()
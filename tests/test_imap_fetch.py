@@ -0,0 +1,27 @@
+from imap_fetch import wait_for_mail
+import imaplib
+import socketserver
+import threading
+import time
+import types
+
+
+class IdleStandIn(socketserver.StreamRequestHandler):
+    # Answers IDLE with the continuation and the EXISTS of a new message in a single packet.
+    def handle(self):
+        self.wfile.write(b'* OK [CAPABILITY IMAP4rev1 IDLE] ready\r\n')
+        tag = self.rfile.readline().split()[0]
+        self.wfile.write(b'+ idling\r\n* 1 EXISTS\r\n')
+        self.rfile.readline()
+        self.wfile.write(tag + b' OK IDLE terminated\r\n')
+        self.rfile.readline()
+
+
+def test_wait_for_mail_sees_exists_sent_with_the_continuation():
+    with socketserver.TCPServer(('127.0.0.1', 0), IdleStandIn) as server:
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        box = imaplib.IMAP4('127.0.0.1', server.server_address[1])
+        start = time.monotonic()
+        assert wait_for_mail(types.SimpleNamespace(box=box), 3)
+        assert time.monotonic() - start < 1
+        box.shutdown()
@@ -0,0 +1,78 @@
+from logging.handlers import QueueHandler, QueueListener
+import config as cfg
+import datetime
+import json
+import logging
+import multiprocessing
+import queue
+
+# Trace logging for the registration pipeline.  Log calls only put the record on a queue, QueueListener threads in
+# the main process format it and write the trace file, so the parsing loop never waits for the disk.  The main process
+# uses an in-process queue, the parse worker processes send their records through a multiprocessing queue (see
+# worker_logging()), so a run still writes a single trace file.
+#
+# The per-field trace is logged at DEBUG with %-style arguments, so at the default INFO level those calls return
+# before any message is formatted.  Set cfg.Logging.level to 'DEBUG' to trace every field of every form.
+
+# Queue of the parse workers, set by start_logging().
+log_queue = None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # Compact structured trace, one JSON object per record.
+    def format(self, record):
+        entry = {'time': round(record.created, 6), 'level': record.levelname, 'process': record.processName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+def create_formatter():
+    if cfg.Logging.format == 'jsonl':
+        return JsonLinesFormatter()
+    if cfg.Logging.format == 'text':
+        return logging.Formatter('%(levelname)s:%(processName)s:%(message)s')
+    raise ValueError(f'Unknown log format {cfg.Logging.format!r}, expected text or jsonl.')
+
+
+def start_logging():
+    # Route the root logger through a queue to the trace file and return the listeners, stop them with stop_logging().
+    global log_queue
+    log_filename = datetime.datetime.now().strftime(cfg.Logging.filename)
+    file_handler = logging.FileHandler(log_filename)
+    file_handler.setFormatter(create_formatter())
+    local_queue = queue.SimpleQueue()
+    log_queue = multiprocessing.Queue(-1)
+    listeners = [QueueListener(local_queue, file_handler), QueueListener(log_queue, file_handler)]
+    for listener in listeners:
+        listener.start()
+    worker_logging(local_queue)
+    return listeners
+
+
+def stop_logging(listeners):
+    # Write out the records still on the queues and close the trace file.
+    global log_queue
+    logging.getLogger().handlers.clear()
+    for listener in listeners:
+        listener.stop()
+    listeners[0].handlers[0].close()
+    log_queue.close()
+    log_queue = None
+
+
+def worker_logging_options():
+    # ProcessPoolExecutor arguments that make the workers log through the trace log queue while it is running.
+    if log_queue is None:
+        return {}
+    return {'initializer': worker_logging, 'initargs': (log_queue,)}
+
+
+def worker_logging(queue):
+    # Send the records of this process to queue at the configured level.  Used as the initializer of the parse
+    # worker processes as well.
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(QueueHandler(queue))
+    root.setLevel(cfg.Logging.level)
@@ -0,0 +1,315 @@
+from applicant import column_position
+from sync_state import save_json
+import argparse
+import config as cfg
+import fnmatch
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import zipfile
+
+# Offline check of callsigns and FRNs against the FCC ULS amateur license database.  The FCC publishes a weekly dump
+# of every amateur license (l_amat.zip) and a daily transaction file of the licenses that changed (l_am_sun.zip,
+# l_am_mon.zip, ...) at https://www.fcc.gov/uls/transactions/daily-weekly.  Dropping them into cfg.Uls.dump_dir is
+# enough: the next run builds a compact index from them, or merges only the dumps it has not seen yet into the index
+# it already has.
+#
+# The index is a file of fixed size records, one per active license, sorted by callsign.  It is memory-mapped and
+# searched by bisection, so opening it costs nothing and a lookup touches a handful of pages.
+#
+# Record layout: callsign, FRN, operator class (T, G, E, A, N, P or a space for club stations), first name and last
+# name.  Names are upper cased and cut to their field size.
+record = struct.Struct('<8sQc11s20s')
+callsign_size = 8
+
+# ULS operator class codes.
+class_names = {'N': 'Novice', 'T': 'Technician', 'P': 'Technician Plus', 'G': 'General', 'A': 'Advanced',
+               'E': 'Amateur Extra'}
+
+FIRST_NAME = column_position['FIRST_NAME']
+LAST_NAME = column_position['LAST_NAME']
+FRN = column_position['FRN']
+CALL_SIGN = column_position['CALL_SIGN']
+UPGRADE_LICENSE = column_position['UPGRADE_LICENSE']
+non_alphanumeric = re.compile(r'\W+')
+non_digit = re.compile(r'\D+')
+
+report_columns = ('FIRST_NAME', 'LAST_NAME', 'CALL_SIGN', 'FRN', 'problem', 'uls_frn', 'uls_name', 'uls_class')
+
+
+def pack(callsign, frn, operator_class, first_name, last_name):
+    return record.pack(callsign.encode('ascii', 'replace'), frn, (operator_class or ' ').encode('ascii', 'replace'),
+                       first_name.upper().encode('latin-1', 'replace'), last_name.upper().encode('latin-1', 'replace'))
+
+
+def unpack(data):
+    # (callsign, frn, operator class, first name, last name) of a packed record.
+    callsign, frn, operator_class, first_name, last_name = record.unpack(data)
+    return (callsign.rstrip(b'\0').decode('ascii'), frn, operator_class.decode('ascii').strip(),
+            first_name.rstrip(b'\0').decode('latin-1', 'replace'), last_name.rstrip(b'\0').decode('latin-1', 'replace'))
+
+
+def read_dat(archive, name):
+    # Split the lines of one .dat file of a ULS dump into fields.  The files are pipe delimited latin-1 text.
+    if name not in archive.namelist():
+        return
+    with archive.open(name) as f:
+        for line in io.TextIOWrapper(f, encoding='latin-1', newline=''):
+            yield line.rstrip('\r\n').split('|')
+
+
+def read_dump(path):
+    # {callsign: packed record or None} of the licenses in a ULS dump, None for licenses that are no longer active.
+    with zipfile.ZipFile(path) as archive:
+        # HD: unique system identifier, callsign and license status (A = active)
+        callsigns = {}
+        inactive = set()
+        for fields in read_dat(archive, 'HD.dat'):
+            if len(fields) > 5 and fields[4]:
+                if fields[5] == 'A':
+                    callsigns[fields[1]] = fields[4]
+                else:
+                    inactive.add(fields[4])
+        # AM: operator class
+        classes = {}
+        for fields in read_dat(archive, 'AM.dat'):
+            if len(fields) > 5 and fields[1] in callsigns:
+                classes[fields[1]] = fields[5]
+        # EN: names and FRN of the licensee
+        licenses = dict.fromkeys(inactive)
+        for fields in read_dat(archive, 'EN.dat'):
+            if len(fields) > 22 and fields[1] in callsigns and fields[5] == 'L':
+                frn = non_digit.sub('', fields[22])
+                licenses[callsigns[fields[1]]] = pack(callsigns[fields[1]], int(frn) if frn else 0,
+                                                      classes.get(fields[1]), fields[8], fields[10] or fields[7])
+    return licenses
+
+
+def merge(records, changes):
+    # Merge the sorted packed records of an index with {callsign: packed record or None} changes, in callsign order.
+    changed = sorted((callsign.encode('ascii', 'replace').ljust(callsign_size, b'\0')[:callsign_size], data)
+                     for callsign, data in changes.items())
+    position = 0
+    for data in records:
+        key = data[:callsign_size]
+        while position < len(changed) and changed[position][0] <= key:
+            if changed[position][1] is not None:
+                yield changed[position][1]
+            if changed[position][0] == key:
+                data = None
+            position += 1
+        if data is not None:
+            yield data
+    for key, data in changed[position:]:
+        if data is not None:
+            yield data
+
+
+def dump_files(dump_dir):
+    # The dumps of dump_dir to build the index from: the newest full dump, then the daily files written after it, in
+    # the order they were written.  Each is described by (name, size, mtime), so a dump that is replaced by a newer
+    # download under the same name counts as new.
+    dumps = []
+    for name in os.listdir(dump_dir):
+        path = os.path.join(dump_dir, name)
+        if fnmatch.fnmatch(name, cfg.Uls.full_dump) or fnmatch.fnmatch(name, cfg.Uls.daily_dump):
+            stat = os.stat(path)
+            dumps.append((stat.st_mtime, name, stat.st_size, fnmatch.fnmatch(name, cfg.Uls.full_dump)))
+    dumps.sort()
+    full = [index for index, dump in enumerate(dumps) if dump[3]]
+    if not full:
+        return []
+    return [[name, size, mtime] for mtime, name, size, _ in dumps[full[-1]:]]
+
+
+def update_index(dump_dir, index_file):
+    # Bring index_file up to date with the dumps in dump_dir.  A new full dump rebuilds the index, new daily dumps
+    # are merged into it.  Returns False if there is no full dump to build from.
+    state_file = index_file + '.json'
+    applied = []
+    if os.path.exists(index_file) and os.path.exists(state_file):
+        with open(state_file) as f:
+            applied = json.load(f)['dumps']
+    dumps = dump_files(dump_dir)
+    if not dumps:
+        return os.path.exists(index_file)
+    rebuild = not applied or dumps[:len(applied)] != applied
+    new = dumps if rebuild else dumps[len(applied):]
+    records = iter(()) if rebuild else iter_records(index_file)
+    if not new:
+        return True
+
+    changes = {}
+    for name, _, _ in new:
+        logging.info('Reading ULS dump %s.', name)
+        changes.update(read_dump(os.path.join(dump_dir, name)))
+    tmp_filename = index_file + '.tmp'
+    count = 0
+    with open(tmp_filename, 'wb') as f:
+        for data in merge(records, changes):
+            f.write(data)
+            count += 1
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, index_file)
+    save_json(state_file, {'dumps': dumps, 'records': count})
+    logging.info('ULS index %s holds %d licenses after %s.', index_file, count,
+                 'a rebuild' if rebuild else f'merging {len(new)} daily dumps')
+    return True
+
+
+def iter_records(index_file):
+    with open(index_file, 'rb') as f:
+        while True:
+            data = f.read(record.size)
+            if len(data) < record.size:
+                return
+            yield data
+
+
+class UlsIndex:
+    def __init__(self, index_file):
+        self.file = open(index_file, 'rb')
+        self.count = os.fstat(self.file.fileno()).st_size // record.size
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+
+    def lookup(self, callsign):
+        # (callsign, frn, operator class, first name, last name) of the active license of callsign, or None.
+        key = callsign.upper().encode('ascii', 'replace')
+        if len(key) > callsign_size:
+            return None
+        key = key.ljust(callsign_size, b'\0')
+        mapped = self.mapped
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * record.size
+            if mapped[offset:offset + callsign_size] < key:
+                low = middle + 1
+            else:
+                high = middle
+        offset = low * record.size
+        if low < self.count and mapped[offset:offset + callsign_size] == key:
+            return unpack(mapped[offset:offset + record.size])
+        return None
+
+    def close(self):
+        if self.count:
+            self.mapped.close()
+        self.file.close()
+
+
+def open_uls_index(dump_dir, index_file):
+    # Update the index from the dumps and open it, or return None if there is neither an index nor a full dump.
+    if os.path.isdir(dump_dir):
+        if not update_index(dump_dir, index_file):
+            logging.warning('No full ULS dump (%s) in %s, callsigns are not checked.', cfg.Uls.full_dump, dump_dir)
+            return None
+    elif os.path.exists(index_file):
+        logging.warning('ULS dump directory %s does not exist, using the index as it is.', dump_dir)
+    else:
+        logging.warning('ULS dump directory %s does not exist, callsigns are not checked.', dump_dir)
+        return None
+    return UlsIndex(index_file)
+
+
+def same_name(entered, licensed):
+    # Compare a name the applicant entered with the name of the license, which was cut to the field size of the index.
+    entered = unpack(pack('', 0, '', '', entered))[4]
+    return non_alphanumeric.sub('', entered) == non_alphanumeric.sub('', licensed)
+
+
+class LicenseCheck:
+    # Checks the callsign, FRN and name of each applicant against the ULS index and sets UPGRADE_LICENSE from the
+    # license the applicant actually holds.  Problems are logged and listed in '<import file>_license_check.csv'.
+    def __init__(self, index):
+        self.index = index
+        self.report = []
+
+    def check(self, applicants):
+        for applicant in applicants:
+            callsign = applicant[CALL_SIGN]
+            if not callsign:
+                continue
+            if callsign == 'ERROR':
+                self.add_report(applicant, 'callsign is not valid', None)
+                continue
+            license = self.index.lookup(callsign)
+            if license is None:
+                applicant[UPGRADE_LICENSE] = False
+                self.add_report(applicant, 'no active license for this callsign', None)
+                continue
+            _, frn, operator_class, first_name, last_name = license
+            applicant[UPGRADE_LICENSE] = True
+            entered_frn = non_digit.sub('', str(applicant[FRN]))
+            if not entered_frn:
+                applicant[FRN] = f'{frn:010d}'
+            elif int(entered_frn) != frn:
+                self.add_report(applicant, 'FRN does not match the license', license)
+            if last_name and not same_name(str(applicant[LAST_NAME]), last_name):
+                self.add_report(applicant, 'last name does not match the license', license)
+            if operator_class == 'E':
+                self.add_report(applicant, 'already holds an Amateur Extra license', license)
+
+    def add_report(self, applicant, problem, license):
+        logging.warning('License check of %s %s (%s): %s.', applicant[FIRST_NAME], applicant[LAST_NAME],
+                        applicant[CALL_SIGN], problem)
+        if license is None:
+            uls = ('', '', '')
+        else:
+            _, frn, operator_class, first_name, last_name = license
+            uls = (f'{frn:010d}', f'{first_name} {last_name}'.strip(), class_names.get(operator_class, 'Club'))
+        self.report.append((applicant[FIRST_NAME], applicant[LAST_NAME], applicant[CALL_SIGN], applicant[FRN],
+                            problem, *uls))
+
+    def write_report(self, export):
+        # Append the problems found since the last call to the license report of export.
+        if self.report:
+            report_filename = export.append_report('_license_check.csv', report_columns, self.report)
+            logging.warning('Found %d license problems, see %s.', len(self.report), report_filename)
+            self.report = []
+
+    def finish(self, export):
+        self.write_report(export)
+
+    def close(self):
+        self.index.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the ULS license index and look up callsigns in it.')
+    parser.add_argument('--dump-dir', default=cfg.Uls.dump_dir, help='directory of ULS dumps (default: %(default)s)')
+    parser.add_argument('--index', default=cfg.Uls.index_file, help='index file (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('update', help='build or update the index from the dumps')
+    lookup = commands.add_parser('lookup', help='show the licenses of callsigns')
+    lookup.add_argument('callsigns', nargs='+', type=str.upper)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    index = open_uls_index(args.dump_dir, args.index)
+    if index is None:
+        return 1
+    try:
+        if args.command == 'lookup':
+            for callsign in args.callsigns:
+                license = index.lookup(callsign)
+                if license is None:
+                    print(f'{callsign}: no active license')
+                else:
+                    _, frn, operator_class, first_name, last_name = license
+                    print(f'{callsign}: FRN {frn:010d}, {first_name} {last_name}, '
+                          f'{class_names.get(operator_class, "Club")}')
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())